@@ -0,0 +1,257 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import heapq
+
+import numpy as np
+import pandas as pd
+
+from gneiss.util import NUMERATOR, DENOMINATOR
+
+
+class TipIndex:
+    """ Tip ranges of the internal nodes of a bifurcating tree.
+
+    Tips are numbered in postorder, so the tips below any internal node
+    form a contiguous range.  Once the index is built, clade membership,
+    clade sizes and the numerator / denominator sizes of every balance are
+    array lookups, and a table whose columns are permuted into tip order
+    can be reduced over any clade with a contiguous slice.
+
+    Parameters
+    ----------
+    tree : skbio.TreeNode
+        Strictly bifurcating tree.
+
+    Attributes
+    ----------
+    tips : list of str
+        Tip names, in postorder.
+    nodes : list of str
+        Internal node names, in level order.
+    start, split, stop : np.ndarray of int
+        The denominator tips of ``nodes[i]`` are ``tips[start[i]:split[i]]``
+        and its numerator tips are ``tips[split[i]:stop[i]]``.
+
+    Raises
+    ------
+    ValueError
+        The tree is not strictly bifurcating.
+    """
+
+    def __init__(self, tree):
+        bounds = {}
+        tips = []
+        for n in tree.postorder(include_self=True):
+            if n.is_tip():
+                bounds[n] = (len(tips), len(tips) + 1)
+                tips.append(n.name)
+            elif len(n.children) == 2:
+                bounds[n] = (bounds[n.children[0]][0],
+                             bounds[n.children[1]][1])
+            else:
+                raise ValueError("Not a strictly bifurcating tree!")
+
+        nodes, start, split, stop = [], [], [], []
+        for n in tree.levelorder(include_self=True):
+            if n.is_tip():
+                continue
+            nodes.append(n.name)
+            start.append(bounds[n.children[DENOMINATOR]][0])
+            split.append(bounds[n.children[DENOMINATOR]][1])
+            stop.append(bounds[n.children[NUMERATOR]][1])
+
+        self.tips = tips
+        self.nodes = nodes
+        self.start = np.array(start, dtype=np.intp)
+        self.split = np.array(split, dtype=np.intp)
+        self.stop = np.array(stop, dtype=np.intp)
+        self._tip_ids = {name: i for i, name in enumerate(tips)}
+        self._node_ids = {name: i for i, name in enumerate(nodes)}
+
+    def node_ids(self, names):
+        """ Positions of the named internal nodes in ``nodes``.
+
+        Raises
+        ------
+        ValueError
+            Some of the names are not internal nodes of the tree.
+        """
+        ids = [self._node_ids.get(name, -1) for name in names]
+        missing = [name for name, i in zip(names, ids) if i < 0]
+        if missing:
+            raise ValueError('Clades %s are not internal nodes of the tree.'
+                             % ', '.join(map(str, missing)))
+        return np.array(ids, dtype=np.intp)
+
+    def ranges(self, ids=None):
+        """ ``(start, split, stop)`` of the given nodes (default all). """
+        if ids is None:
+            return self.start, self.split, self.stop
+        return self.start[ids], self.split[ids], self.stop[ids]
+
+    def sizes(self, ids=None):
+        """ Numerator (r) and denominator (s) tip counts of the nodes. """
+        start, split, stop = self.ranges(ids)
+        return stop - split, split - start
+
+    def contains(self, node, tip):
+        """ Whether ``tip`` lies below the internal node ``node``. """
+        i = self._node_ids[node]
+        return self.start[i] <= self._tip_ids[tip] < self.stop[i]
+
+    def permutation(self, features):
+        """ Column indexer that reorders ``features`` into tip order.
+
+        Features that are not tips are dropped.
+
+        Raises
+        ------
+        ValueError
+            Some tips are not present in ``features``.
+        """
+        perm = pd.Index(features).get_indexer(self.tips)
+        if (perm < 0).any():
+            missing = [t for t, i in zip(self.tips, perm) if i < 0]
+            raise ValueError('Tips %s are not present in the table.'
+                             % ', '.join(map(str, missing)))
+        return perm
+
+
+def average_linkage_1d(values):
+    """ Average linkage of one-dimensional observations.
+
+    On a line, the clusters of average linkage are intervals of the
+    sorted observations, and the average distance between two intervals
+    that do not overlap is the difference of their means.  So the
+    observations are sorted once, only clusters that are adjacent in
+    sorted order are candidates for a merge, and the gaps between them
+    are kept in a heap, where every merge replaces two gaps by those of
+    the new cluster to its neighbors.  This takes O(n log n) time and
+    O(n) memory, instead of the O(n^2) of a distance matrix.  Equal gaps
+    are merged from left to right in sorted order, so the tree does not
+    depend on the order of the observations; without ties, it is that of
+    ``scipy.cluster.hierarchy.linkage``.
+
+    Parameters
+    ----------
+    values : array_like of float
+        Observations.
+
+    Returns
+    -------
+    np.ndarray
+        Linkage matrix, as returned by
+        ``scipy.cluster.hierarchy.linkage(pdist(values[:, None]),
+        'average')``.
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    n = len(values)
+    if n < 2:
+        raise ValueError('At least two observations are needed, not %d.'
+                         % n)
+    order = np.argsort(values, kind='stable')
+    # the clusters are kept in sorted order, at the position of their
+    # leftmost observation, in a doubly linked list
+    total = values[order].tolist()
+    size = [1] * n
+    cluster = order.tolist()
+    right = list(range(1, n)) + [-1]
+    left = list(range(-1, n - 1))
+
+    # a gap is stale once either of its clusters has merged
+    heap = [(total[i + 1] - total[i], i, i + 1, cluster[i], cluster[i + 1])
+            for i in range(n - 1)]
+    heapq.heapify(heap)
+    Z = np.empty((n - 1, 4))
+    height = 0.0
+    for k in range(n - 1):
+        while True:
+            d, i, j, a, b = heapq.heappop(heap)
+            if cluster[i] == a and cluster[j] == b and right[i] == j:
+                break
+        height = max(d, height)
+        total[i] += total[j]
+        size[i] += size[j]
+        Z[k] = min(a, b), max(a, b), height, size[i]
+        cluster[i] = n + k
+        cluster[j] = -1
+        right[i] = right[j]
+        if right[i] >= 0:
+            left[right[i]] = i
+        for p, q in ((left[i], i), (i, right[i])):
+            if p >= 0 and q >= 0:
+                gap = total[q] / size[q] - total[p] / size[p]
+                heapq.heappush(heap, (gap, p, q, cluster[p], cluster[q]))
+    return Z
+
+
+def gradient_sort(tree, gradient, ascending=True, inplace=False):
+    """ Sorts the children of every node of a tree along a gradient.
+
+    Like ``gneiss.sort.gradient_sort``, the children of every internal
+    node are ordered by the mean gradient of their tips.  The nodes are
+    numbered in preorder, with the position of their parent, so the sums
+    and counts of the gradient over all the subtrees are accumulated in a
+    single pass over the nodes in reverse, and every node is then
+    reordered once.  This takes O(n) time, instead of walking the tips of
+    every child of every node, and no recursion, so deep trees do not
+    hit the recursion limit.
+
+    Parameters
+    ----------
+    tree : skbio.TreeNode
+        Tree whose tips are in the index of ``gradient``.
+    gradient : pd.Series
+        Numeric gradient value of every tip.
+    ascending : bool
+        Whether the children are sorted by increasing mean gradient.
+    inplace : bool
+        Whether ``tree`` itself is sorted, rather than a copy, which saves
+        the deep copy of every node when the tree is not needed anymore.
+
+    Returns
+    -------
+    skbio.TreeNode
+        Sorted tree.
+
+    Raises
+    ------
+    ValueError
+        ``gradient`` is not numeric.
+    """
+    if not np.issubdtype(gradient.dtype, np.number):
+        raise ValueError('`gradient` needs to be numeric, not %s' %
+                         gradient.dtype)
+    if not inplace:
+        tree = tree.copy()
+    nodes = list(tree.preorder(include_self=True))
+    index = {id(n): i for i, n in enumerate(nodes)}
+    parent = [-1] + [index[id(n.parent)] for n in nodes[1:]]
+    tips = [i for i, n in enumerate(nodes) if n.is_tip()]
+    total = np.zeros(len(nodes))
+    count = np.zeros(len(nodes))
+    total[tips] = gradient.loc[[nodes[i].name for i in tips]].values
+    count[tips] = 1
+    for i in range(len(nodes) - 1, 0, -1):
+        total[parent[i]] += total[i]
+        count[parent[i]] += count[i]
+    with np.errstate(invalid='ignore'):
+        mean = total / count
+    # skbio's TreeNode.subset is empty on a tip, so gneiss gives tips a nan
+    # mean, which sorts them after their internal siblings; this is kept
+    # so that the trees are the same
+    mean[tips] = np.nan
+    for node in nodes:
+        if len(node.children) < 2:
+            continue
+        ids = [index[id(c)] for c in node.children]
+        order = np.argsort(mean[ids], kind='stable')
+        if not ascending:
+            order = order[::-1]
+        node.children = [node.children[i] for i in order]
+    return tree
@@ -5,7 +5,9 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
-from ._cluster import correlation_clustering, gradient_clustering
+from ._cluster import (correlation_clustering, divisive_clustering,
+                       gradient_clustering, multi_gradient_clustering)
 
 
-__all__ = ["correlation_clustering", "gradient_clustering"]
+__all__ = ["correlation_clustering", "divisive_clustering",
+           "gradient_clustering", "multi_gradient_clustering"]
@@ -0,0 +1,166 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from q2_gneiss.cluster._distance import _SparseProfiles, _attach, _share
+
+
+def _linkage_clades(lm, n):
+    """ Clades of the merges of a linkage matrix of ``n`` observations.
+
+    Every clade is a bitset of its observations, stored in a python
+    integer (bit ``i`` for observation ``i``), so it takes ``n / 8`` bytes,
+    is built from the clades of its children with a single or, and is
+    hashable.
+    """
+    bits = [1 << i for i in range(n)]
+    for a, b in lm[:, :2].astype(np.intp).tolist():
+        bits.append(bits[a] | bits[b])
+    return bits[n:]
+
+
+def _tree_clades(tree, features):
+    """ Internal nodes of a tree and their clades.
+
+    The clades are bitsets over the positions of their tips in
+    ``features`` (see ``_linkage_clades``).  Nodes with tips that are not
+    in ``features`` are left out, and so is the node of all the features
+    (the root of their hierarchy), which every replicate contains.
+    """
+    index = {f: i for i, f in enumerate(features)}
+    everything = (1 << len(features)) - 1
+    bits = {}
+    nodes, clades = [], []
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            i = index.get(node.name)
+            bits[node] = None if i is None else 1 << i
+            continue
+        children = [bits[c] for c in node.children]
+        if any(c is None for c in children):
+            bits[node] = None
+            continue
+        bits[node] = 0
+        for c in children:
+            bits[node] |= c
+        if bits[node] != everything:
+            nodes.append(node)
+            clades.append(bits[node])
+    return nodes, clades
+
+
+def _resample(profiles, ids):
+    """ Profiles (see ``_profiles``) of the table restricted to the
+    samples ``ids``, drawn with replacement, from those of the whole
+    table.  There are as many samples, so only the centering changes.
+    """
+    if isinstance(profiles, _SparseProfiles):
+        logs = csr_matrix(profiles.logs[:, ids])
+        mean = np.asarray(logs.mean(axis=1),
+                          dtype=profiles.mean.dtype).ravel()
+        return _SparseProfiles(logs, mean)
+    res = profiles[:, ids]
+    res -= res.mean(axis=1, keepdims=True)
+    return res
+
+
+def _bootstrap_ids(seed, replicate, n_samples):
+    # samples of a bootstrap replicate, drawn from the seed and the number
+    # of the replicate, so that they do not depend on the worker
+    state = np.random.RandomState([seed, replicate])
+    return state.randint(0, n_samples, n_samples)
+
+
+def _hits(func, data, args, reference, seed, b):
+    # which of the reference clades replicate `b` contains
+    lm = func(data, _bootstrap_ids(seed, b, data.shape[-1]), *args)
+    found = set(_linkage_clades(lm, len(lm) + 1))
+    return np.array([c in found for c in reference])
+
+
+# State of a worker process of ``_bootstrap_support``.
+_worker = {}
+
+
+def _init_worker(data_spec, func, args, reference, seed):
+    shared, data = _attach(data_spec)
+    _worker['shared'] = shared
+    _worker['hits'] = partial(_hits, func, data, args, reference, seed)
+
+
+def _worker_hits(b):
+    return _worker['hits'](b)
+
+
+def _bootstrap_support(clades, data, func, args=(), n_bootstraps=100,
+                       seed=0, n_jobs=1):
+    """ Bootstrap support of clades of a hierarchy of features.
+
+    In every replicate, as many samples as in the table are drawn with
+    replacement, ``func(data, ids, *args)`` builds the linkage matrix of
+    the features from them, and the clades of the replicate (see
+    ``_linkage_clades``) are looked up in a hash set.  With ``n_jobs``
+    greater than one, the replicates are run by a pool of processes that
+    share ``data`` through ``multiprocessing.shared_memory`` (see
+    ``q2_gneiss.cluster._distance._share``), so it is copied once, and
+    every replicate only returns which of the clades it contains.  The
+    samples of a replicate only depend on ``seed`` and its number, so the
+    support does not depend on ``n_jobs``.
+
+    Parameters
+    ----------
+    clades : list of int
+        Clades, as bitsets over the features.
+    data : np.ndarray or _SparseProfiles
+        Data of the features, whose last axis is the samples.
+    func : callable
+        Module-level function that returns a linkage matrix of the features
+        from ``data``, the samples of a replicate and ``args``.
+    args : tuple
+        Further arguments of ``func``.
+    n_bootstraps : int
+        Number of replicates.
+    seed : int
+        Seed of the replicates.
+    n_jobs : int
+        Number of processes running the replicates.
+
+    Returns
+    -------
+    np.ndarray
+        Fraction of the replicates in which every clade occurs.
+    """
+    if n_jobs < 1:
+        raise ValueError('`n_jobs` must be positive, not %r.' % n_jobs)
+    if n_jobs == 1:
+        hits = partial(_hits, func, data, args, clades, seed)
+        counts = sum(hits(b) for b in range(n_bootstraps))
+        return counts / n_bootstraps
+    shared, data_spec = _share(data)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(data_spec, func, args, clades,
+                                           seed)) as pool:
+            counts = sum(pool.map(_worker_hits, range(n_bootstraps)))
+    finally:
+        for s in shared:
+            s.close()
+    return counts / n_bootstraps
+
+
+def _label_support(nodes, support):
+    """ Prefixes the names of nodes with their support, like
+    ``'0.95:y1'``, which ``skbio.TreeNode.assign_supports`` reads back.
+    """
+    for node, s in zip(nodes, support):
+        node.name = '%g:%s' % (s, node.name)
@@ -0,0 +1,184 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import hashlib
+import os
+import time
+
+import numpy as np
+from scipy.sparse import issparse
+
+from q2_gneiss.cluster._distance import _profile_variation, _tile_rows
+from q2_gneiss.cluster._ward import _matrix_ward
+
+
+# Least number of seconds between two checkpoints.
+_CHECKPOINT_SECONDS = 60
+
+
+def _fingerprint(mat, *options):
+    """ Digest of a table and of the options of a run, which identifies
+    the checkpoints of the run.
+    """
+    digest = hashlib.sha256(repr(options).encode())
+    digest.update(repr(mat.shape).encode())
+    if issparse(mat):
+        mat = mat.tocsr()
+        arrays = [mat.data, mat.indices, mat.indptr]
+    else:
+        arrays = [np.asarray(mat)]
+    for a in arrays:
+        digest.update(np.ascontiguousarray(a).data)
+    return digest.hexdigest()
+
+
+class _Checkpoint:
+    """ Resumable variation matrix and Ward linkage of the 'matrix'
+    engine, kept in ``directory``.
+
+    The condensed variation matrix is a float64 ``np.memmap`` in the
+    directory, linked in place by ``_matrix_ward``, so the tree is the
+    same as that of ``scipy.cluster.hierarchy.linkage``.  At most every
+    ``_CHECKPOINT_SECONDS``, the matrix is flushed and the state of the
+    run is saved: the number of tiles of the matrix that are written, and
+    then the merges, cluster sizes and nearest neighbor chain of the
+    linkage.  The state is replaced atomically, so a run that is killed
+    always leaves a complete one.
+
+    The linkage overwrites the matrix after the last checkpoint.  Before
+    every merge overwrites distances, they are appended to an undo log,
+    and a rerun first writes them back, from the last merge to the first,
+    to restore the matrix of the last checkpoint.  A merge that was
+    killed while appending to the log had not overwritten anything yet.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the checkpoint files.
+    fingerprint : str
+        Digest of the inputs of the run (see ``_fingerprint``).  A
+        checkpoint of a run with other inputs is an error.
+    n : int
+        Number of features.
+    """
+
+    def __init__(self, directory, fingerprint, n):
+        self.n = n
+        self.fingerprint = fingerprint
+        self._state_path = os.path.join(directory, 'state.npz')
+        self._dist_path = os.path.join(directory, 'variation.f64')
+        self._undo_path = os.path.join(directory, 'undo.log')
+        self.state = self._load()
+        self.dist = np.memmap(self._dist_path, dtype=np.float64,
+                              mode='w+' if self.state is None else 'r+',
+                              shape=(n * (n - 1) // 2,))
+        self._undo = None
+        self._last = time.monotonic()
+
+    def _load(self):
+        if not os.path.exists(self._state_path):
+            return None
+        with np.load(self._state_path) as f:
+            state = {k: f[k] for k in f.files}
+        if str(state['fingerprint']) != self.fingerprint:
+            raise ValueError('%s holds the checkpoint of a run with other '
+                             'inputs.' % os.path.dirname(self._state_path))
+        return state
+
+    def _save(self, **state):
+        self.dist.flush()
+        tmp = self._state_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, fingerprint=self.fingerprint, **state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._state_path)
+        self.state = state
+        self._last = time.monotonic()
+
+    def _due(self):
+        return time.monotonic() - self._last >= _CHECKPOINT_SECONDS
+
+    def variation(self, profiles, n_jobs=1):
+        """ Writes the variations between ``profiles`` into ``dist``, from
+        the last checkpoint on.
+        """
+        step = _tile_rows(self.n)
+        start = 0
+        if self.state is not None:
+            if 'merges' in self.state:
+                return
+            if int(self.state['step']) == step:
+                start = int(self.state['tiles'])
+
+        def progress(i):
+            if self._due():
+                self._save(step=step, tiles=i + 1)
+
+        _profile_variation(profiles, out=self.dist, n_jobs=n_jobs,
+                           start=start, progress=progress)
+        self._save(merges=np.empty((0, 4)), size=np.ones(self.n),
+                   active=np.ones(self.n, dtype=bool),
+                   chain=np.empty(0, dtype=np.intp))
+
+    def linkage(self):
+        """ Ward linkage of ``dist``, from the last checkpoint on. """
+        return _matrix_ward(self.dist, self.n, journal=self)
+
+    def resume(self):
+        state = self.state
+        k = len(state['merges'])
+        if os.path.exists(self._undo_path):
+            for record, pos, old in reversed(self._undo_records()):
+                # merges before the checkpoint are part of it
+                if record >= k:
+                    self.dist[pos] = old
+            self.dist.flush()
+        self._undo = open(self._undo_path, 'wb')
+        return (k, state['merges'], state['size'], state['active'],
+                state['chain'].tolist())
+
+    def _undo_records(self):
+        with open(self._undo_path, 'rb') as f:
+            log = f.read()
+        records = []
+        offset = 0
+        while offset + 16 <= len(log):
+            k, m = np.frombuffer(log, dtype=np.int64, count=2,
+                                 offset=offset).tolist()
+            end = offset + 16 + 16 * m
+            if end > len(log):
+                break
+            pos = np.frombuffer(log, dtype=np.int64, count=m,
+                                offset=offset + 16)
+            old = np.frombuffer(log, dtype=np.float64, count=m,
+                                offset=offset + 16 + 8 * m)
+            records.append((k, pos, old))
+            offset = end
+        return records
+
+    def before(self, k, pos, old):
+        self._undo.write(np.array([k, len(pos)], dtype=np.int64).tobytes())
+        self._undo.write(pos.astype(np.int64).tobytes())
+        self._undo.write(np.asarray(old, dtype=np.float64).tobytes())
+        self._undo.flush()
+
+    def after(self, k, Z, size, active, chain):
+        if self._due():
+            self._save(merges=Z[:k], size=size, active=active,
+                       chain=np.array(chain, dtype=np.intp))
+            self._undo.seek(0)
+            self._undo.truncate()
+
+    def close(self):
+        """ Removes the checkpoint files. """
+        if self._undo is not None:
+            self._undo.close()
+        del self.dist
+        for path in [self._state_path, self._dist_path, self._undo_path]:
+            if os.path.exists(path):
+                os.remove(path)
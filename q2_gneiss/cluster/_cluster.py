@@ -5,43 +5,244 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import os
+import tempfile
 import uuid
+import biom
+import numpy as np
 import pandas as pd
 import skbio
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import issparse
 
 from q2_types.feature_table import (FeatureTable, Frequency, RelativeFrequency,
                                     Composition)
+import qiime2
 from qiime2 import NumericMetadataColumn
 from q2_types.tree import Hierarchy, Phylogeny, Rooted
-from qiime2.plugin import MetadataColumn, Numeric, Bool, Float
-from gneiss.cluster._pba import correlation_linkage
-from gneiss.sort import gradient_sort, mean_niche_estimator
-from gneiss.util import rename_internal_nodes, match, match_tips
+from qiime2.plugin import (Collection, MetadataColumn, Metadata, Numeric,
+                           Bool, Float, Str, Choices, Int, Range)
+from gneiss.util import rename_internal_nodes, match_tips
 
 from q2_gneiss.plugin_setup import plugin
-from q2_gneiss._util import add_pseudocount
-from q2_gneiss.hacks import gradient_linkage
+from q2_gneiss._tree import average_linkage_1d, gradient_sort
+from q2_gneiss._util import (_dtype, _matrix, _precisions,
+                             _precision_description)
+from q2_gneiss.cluster._bootstrap import (_bootstrap_support, _label_support,
+                                          _resample, _tree_clades)
+from q2_gneiss.cluster._checkpoint import _Checkpoint, _fingerprint
+from q2_gneiss.cluster._distance import (_SparseProfiles, _profile_variation,
+                                         _profiles, _sketch)
+from q2_gneiss.cluster._divisive import _divisive_tree
+from q2_gneiss.cluster._filter import _feature_filter
+from q2_gneiss.cluster._gradient import _align, _mean_niche
+from q2_gneiss.cluster._knn import _knn_ward, _rp_knn
+from q2_gneiss.cluster._ward import _matrix_ward, _vector_ward
+from q2_gneiss.hacks import _rank_linkage
 
 
-def correlation_clustering(table: pd.DataFrame, pseudocount: float = 0.5
-                           ) -> skbio.TreeNode:
+_engines = ['matrix', 'vector', 'knn']
+_n_bootstraps_description = (
+    "Number of bootstrap replicates, in which the samples are drawn with "
+    "replacement and the features are clustered again, from which the "
+    "support of every clade of the hierarchy is estimated.  If nonzero, the "
+    "names of the internal nodes are prefixed with the fraction of the "
+    "replicates that contain the same clade, e.g. '0.95:y1'.  The root has "
+    "no support.")
+
+
+def correlation_clustering(table: biom.Table, pseudocount: float = 0.5,
+                           precision: str = 'float64',
+                           engine: str = 'matrix',
+                           scratch_dir: str = None,
+                           n_jobs: int = 1,
+                           n_neighbors: int = 10,
+                           random_seed: int = 0,
+                           sketch_distortion: float = None,
+                           min_prevalence: float = 0.0,
+                           min_total_count: int = 0,
+                           top_k_var: int = None,
+                           n_bootstraps: int = 0,
+                           checkpoint_dir: str = None) -> skbio.TreeNode:
     """ Builds a tree for features based on correlation.
 
     Parameters
     ----------
-    table : pd.DataFrame
+    table : biom.Table or pd.DataFrame
        Contingency table where rows are samples and columns are features.
-       In addition, the table must have strictly nonzero values.
+       A biom table is kept sparse by the 'matrix' engine.
+    pseudocount : float
+       The value that replaces zero counts.
+    precision : str
+       Floating point type of the logs and of the distances, either
+       'float64' or 'float32' (see ``q2_gneiss._util._dtype`` for the
+       accuracy of 'float32').
+    engine : str
+       'matrix' runs Ward linkage on the condensed matrix of variations
+       between features, which takes memory quadratic in the number of
+       features.  'vector' runs Ward linkage on the centered log profiles
+       of the features, whose squared euclidean distances are those
+       variations, without forming any pairwise matrix, in memory linear
+       in the number of features.  The two are different clusterings:
+       'matrix' treats the variations as plain distances rather than
+       squared ones.  'knn' is an approximation of 'vector' for very many
+       features, in time roughly linear in their number: Ward merges are
+       restricted to the edges of an approximate nearest neighbor graph
+       of the profiles, built with random projection trees, until about
+       twice the square root of the number of features are left as
+       clusters, which are then merged without restriction.  It recovers
+       the fine structure of 'vector' better than its top splits.
+    scratch_dir : str, optional
+       With the 'matrix' engine, the condensed variation matrix is stored
+       as float32 in a temporary file in this directory, instead of in
+       memory, and is linked in place.  Linking reads the matrix by
+       columns as well as by rows, so the file must fit in the page cache
+       (free memory) to be fast; it halves the memory of the float64
+       matrix, but does not make matrices larger than memory practical.
+    n_jobs : int
+       With the 'matrix' engine, number of processes that compute the
+       variation matrix, and number of processes that run the bootstrap
+       replicates.
+    n_neighbors : int
+       With the 'knn' engine, number of neighbors of every feature.
+    random_seed : int
+       Seed of the random projections of the 'knn' engine and of the
+       sketch.
+    sketch_distortion : float, optional
+       If given, the centered log profiles of the features are projected
+       on a few random directions (a Johnson-Lindenstrauss sketch), so
+       that the variations between features are kept within a factor of
+       ``1 +/- sketch_distortion`` with high probability, and cost time
+       proportional to the number of directions instead of the number of
+       samples (see ``q2_gneiss.cluster._distance._sketch``).  The number
+       of directions grows with the logarithm of the number of features
+       and with the inverse square of the distortion: about 450 for 0.5
+       and 10000 features.  Tables with fewer samples than that are not
+       sketched, so this only helps tables with many thousands of
+       samples.
+    min_prevalence : float
+       Smallest fraction of samples in which a feature is observed for it
+       to be clustered.
+    min_total_count : int
+       Smallest total count of a feature for it to be clustered.
+    top_k_var : int, optional
+       Number of the features with the most variable logs that are
+       clustered, among those that pass the other filters.
+    n_bootstraps : int
+       Number of bootstrap replicates of the samples from which the
+       support of the clades is estimated.  The replicates are run by
+       ``n_jobs`` processes.
+    checkpoint_dir : str, optional
+       With the 'matrix' engine, directory in which the variation matrix,
+       which takes 4 * n^2 bytes for n features, and the linkage are
+       periodically checkpointed (see
+       ``q2_gneiss.cluster._checkpoint._Checkpoint``).  A rerun with the
+       same table, parameters and directory resumes from the last
+       checkpoint.  The checkpoint is removed once the linkage is
+       complete.  The matrix is stored in double precision in place of
+       ``scratch_dir``, and the bootstrap replicates are not
+       checkpointed.
 
     Returns
     -------
     skbio.TreeNode
        Represents the partitioning of features with respect to correlation.
+       Features removed by the filters form a trailing clade, the second
+       child of the root.  With bootstrap replicates, the names of the
+       internal nodes of the clustered features, except the root, are
+       prefixed with their support, e.g. ``'0.95:y1'`` (see
+       ``skbio.TreeNode.assign_supports``).
     """
-    t = correlation_linkage(add_pseudocount(table, pseudocount))
+    dtype = _dtype(precision)
+    mat, _, features = _matrix(table)
+    if engine not in _engines:
+        raise ValueError('`engine` must be one of %s, not %r.'
+                         % (', '.join(_engines), engine))
+    ids = _feature_filter(mat, pseudocount, min_prevalence, min_total_count,
+                          top_k_var)
+    if len(ids) < 2:
+        raise ValueError('At least 2 features must pass the filters, not '
+                         '%d.' % len(ids))
+    filtered = [features[i] for i in np.setdiff1d(np.arange(len(features)),
+                                                  ids)]
+    if filtered:
+        mat = mat[:, ids]
+        features = [features[i] for i in ids]
+    if issparse(mat) and (engine == 'matrix' or
+                          sketch_distortion is not None):
+        profiles = _SparseProfiles.from_counts(mat, pseudocount, dtype=dtype)
+    else:
+        profiles = _profiles(mat, pseudocount, dtype=dtype)
+    options = (engine, scratch_dir, n_neighbors, random_seed,
+               sketch_distortion)
+    checkpoint = None
+    if checkpoint_dir is not None and engine == 'matrix':
+        fingerprint = _fingerprint(mat, features, pseudocount, precision,
+                                   random_seed, sketch_distortion)
+        checkpoint = _Checkpoint(checkpoint_dir, fingerprint, len(features))
+    lm = _correlation_linkage(profiles, *options, n_jobs=n_jobs,
+                              checkpoint=checkpoint)
+    t = skbio.TreeNode.from_linkage_matrix(lm, features)
+    if filtered:
+        t = _attach_clade(t, filtered)
+    t = rename_internal_nodes(t)
+    if n_bootstraps:
+        nodes, clades = _tree_clades(t, features)
+        support = _bootstrap_support(clades, profiles, _correlation_replicate,
+                                     options, n_bootstraps, seed=random_seed,
+                                     n_jobs=n_jobs)
+        _label_support(nodes, support)
     return t
 
 
+def _correlation_linkage(profiles, engine, scratch_dir=None, n_neighbors=10,
+                         seed=0, distortion=None, n_jobs=1, checkpoint=None):
+    # Ward linkage of the features from their profiles (see `_profiles`),
+    # which may be sparse with the 'matrix' engine or a sketch
+    if distortion is not None:
+        profiles = _sketch(profiles, distortion, seed)
+    if engine != 'matrix' and isinstance(profiles, _SparseProfiles):
+        profiles = profiles.toarray()
+    if engine == 'vector':
+        return _vector_ward(profiles)
+    if engine == 'knn':
+        neighbors, _ = _rp_knn(profiles, n_neighbors, seed=seed)
+        return _knn_ward(profiles, neighbors)
+    if checkpoint is not None:
+        checkpoint.variation(profiles, n_jobs=n_jobs)
+        lm = checkpoint.linkage()
+        checkpoint.close()
+        return lm
+    if scratch_dir is None:
+        return linkage(_profile_variation(profiles, n_jobs=n_jobs),
+                       method='ward')
+    n = profiles.shape[0]
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmp:
+        dist = np.memmap(os.path.join(tmp, 'variation.f32'),
+                         dtype=np.float32, mode='w+',
+                         shape=(n * (n - 1) // 2,))
+        _profile_variation(profiles, out=dist, n_jobs=n_jobs)
+        lm = _matrix_ward(dist, n)
+        del dist
+    return lm
+
+
+def _correlation_replicate(profiles, ids, *options):
+    # linkage of a bootstrap replicate (see `_bootstrap_support`)
+    return _correlation_linkage(_resample(profiles, ids), *options)
+
+
+def _attach_clade(tree, names):
+    # joins `tree` and a bifurcating clade of the tips `names` under a new
+    # root, with the clade as its second child
+    clade = skbio.TreeNode(children=[skbio.TreeNode(name=n) for n in names])
+    clade.bifurcate()
+    if len(names) == 1:
+        clade = clade.children[0]
+        clade.parent = None
+    return skbio.TreeNode(children=[tree, clade])
+
+
 plugin.methods.register_function(
     function=correlation_clustering,
     inputs={'table': FeatureTable[Frequency]},
@@ -50,9 +251,60 @@ plugin.methods.register_function(
     input_descriptions={
         'table': ('The feature table containing the samples in which '
                   'the columns will be clustered.')},
-    parameters={'pseudocount': Float},
+    parameters={'pseudocount': Float,
+                'precision': Str % Choices(_precisions),
+                'engine': Str % Choices(_engines),
+                'scratch_dir': Str,
+                'n_jobs': Int % Range(1, None),
+                'n_neighbors': Int % Range(1, None),
+                'random_seed': Int % Range(0, None),
+                'sketch_distortion': Float % Range(0, 1,
+                                                   inclusive_start=False),
+                'min_prevalence': Float % Range(0, 1, inclusive_end=True),
+                'min_total_count': Int % Range(0, None),
+                'top_k_var': Int % Range(2, None),
+                'n_bootstraps': Int % Range(0, None),
+                'checkpoint_dir': Str},
     parameter_descriptions={
-        'pseudocount': 'The value to add to zero counts in the feature table.'
+        'pseudocount': 'The value to add to zero counts in the feature table.',
+        'precision': _precision_description,
+        'engine': ("Ward clustering engine: 'matrix' (pairwise matrix), "
+                   "'vector' (linear memory) or 'knn' (approximate)."),
+        'scratch_dir': ("Directory in which to keep the pairwise matrix of "
+                        "the 'matrix' engine, stored in single precision, "
+                        "instead of in memory.  The matrix takes 2 * n^2 "
+                        "bytes for n features and is deleted once the "
+                        "tree is built.  Single precision storage may "
+                        "change the tree where distances are nearly tied.  "
+                        "The file must fit in free memory (the page "
+                        "cache): linking a larger one reads the disk at "
+                        "random and is impractically slow."),
+        'n_jobs': ("Number of processes that compute the pairwise matrix "
+                   "of the 'matrix' engine, and that run the bootstrap "
+                   "replicates.  The processes share the log transformed "
+                   "table and the matrix through shared memory.  The "
+                   "results do not depend on the number of processes."),
+        'n_neighbors': ("Number of nearest neighbors of every feature in "
+                        "the graph of the 'knn' engine.  More neighbors "
+                        "are slower and closer to the 'vector' engine."),
+        'random_seed': ("Seed of the random projections that find the "
+                        "nearest neighbors of the 'knn' engine, and of the "
+                        "sketch of `sketch_distortion`."),
+        'sketch_distortion': ("If specified, largest relative error of the "
+                              "distances, which are computed on a random "
+                              "sketch of the samples."),
+        'min_prevalence': ("Smallest fraction of samples in which a feature "
+                           "must be observed to be clustered."),
+        'min_total_count': ("Smallest total count across samples of a "
+                            "feature for it to be clustered."),
+        'top_k_var': ("If specified, only the features with the most "
+                      "variable log abundances, among those that pass the "
+                      "other filters, are clustered.  The cost of "
+                      "clustering grows quadratically with the number of "
+                      "features."),
+        'n_bootstraps': _n_bootstraps_description,
+        'checkpoint_dir': ("Directory from which an interrupted run of the "
+                           "'matrix' engine resumes.")
     },
     output_descriptions={
         'clustering': ('A hierarchy of feature identifiers where each tip '
@@ -63,20 +315,121 @@ plugin.methods.register_function(
     description=('Build a bifurcating tree that represents a hierarchical '
                  'clustering of features.  The hiearchical clustering '
                  'uses Ward hierarchical clustering based on the degree of '
-                 'proportionality between features.')
+                 'proportionality between features.  Features removed by '
+                 'the prevalence, count or variance filters are not '
+                 'clustered, and are placed in a separate clade under the '
+                 'root, so that the tree still contains every feature.')
 )
 
 
-def gradient_clustering(table: pd.DataFrame,
+def divisive_clustering(table: biom.Table, pseudocount: float = 0.5,
+                        precision: str = 'float64',
+                        n_iter: int = 5,
+                        random_seed: int = 0,
+                        n_jobs: int = 1) -> skbio.TreeNode:
+    """ Builds a tree for features top-down, by principal balances.
+
+    Parameters
+    ----------
+    table : biom.Table or pd.DataFrame
+       Contingency table where rows are samples and columns are features.
+       A biom table is kept sparse.
+    pseudocount : float
+       The value that replaces zero counts.
+    precision : str
+       Floating point type of the logs, either 'float64' or 'float32'.
+    n_iter : int
+       Number of power iterations that approximate the leading principal
+       component of the features of every node.
+    random_seed : int
+       Seed of the starting vectors of the power iterations.
+    n_jobs : int
+       Number of threads that split the nodes of a level of the tree.
+
+    Returns
+    -------
+    skbio.TreeNode
+       Represents the partitioning of features with respect to their
+       principal components.
+    """
+    dtype = _dtype(precision)
+    mat, _, features = _matrix(table)
+    if len(features) < 2:
+        raise ValueError('At least 2 features are needed, not %d.'
+                         % len(features))
+    if issparse(mat):
+        profiles = _SparseProfiles.from_counts(mat, pseudocount, dtype=dtype)
+    else:
+        profiles = _profiles(mat, pseudocount, dtype=dtype)
+    t = _divisive_tree(profiles, features, n_iter=n_iter, seed=random_seed,
+                       n_jobs=n_jobs)
+    t = rename_internal_nodes(t)
+    return t
+
+
+plugin.methods.register_function(
+    function=divisive_clustering,
+    inputs={'table': FeatureTable[Frequency]},
+    outputs=[('clustering', Hierarchy)],
+    name='Divisive hierarchical clustering using principal balances.',
+    input_descriptions={
+        'table': ('The feature table containing the samples in which '
+                  'the columns will be clustered.')},
+    parameters={'pseudocount': Float,
+                'precision': Str % Choices(_precisions),
+                'n_iter': Int % Range(1, None),
+                'random_seed': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None)},
+    parameter_descriptions={
+        'pseudocount': 'The value to add to zero counts in the feature table.',
+        'precision': _precision_description,
+        'n_iter': ("Number of power iterations that approximate the "
+                   "leading principal component of the features at every "
+                   "node.  More iterations are slower and closer to the "
+                   "exact principal component."),
+        'random_seed': ("Seed of the starting vectors of the power "
+                        "iterations."),
+        'n_jobs': ("Number of threads that split the nodes of a level of "
+                   "the tree.  The tree does not depend on the number of "
+                   "threads.")
+    },
+    output_descriptions={
+        'clustering': ('A hierarchy of feature identifiers where each tip '
+                       'corresponds to the feature identifiers in the table. '
+                       'This tree can contain tip ids that are not present in '
+                       'the table, but all feature ids in the table must be '
+                       'present in this tree.')},
+    description=('Build a bifurcating tree that represents a hierarchical '
+                 'clustering of features, from the root down.  The '
+                 'features of every node are split by the sign of their '
+                 'leading principal component, computed on their centered '
+                 'log-transformed abundances by power iteration, so that '
+                 'the balance between the two parts is roughly the most '
+                 'variable one.  Its cost grows like n log n in the number '
+                 'of features n when the splits are balanced, rather than '
+                 'quadratically like correlation-clustering, so it scales '
+                 'to very large numbers of features.')
+)
+
+
+def gradient_clustering(table: biom.Table,
                         gradient: NumericMetadataColumn,
                         ignore_missing_samples: bool = False,
-                        weighted: bool = True) -> skbio.TreeNode:
+                        weighted: bool = True,
+                        n_bootstraps: int = 0,
+                        random_seed: int = 0,
+                        n_jobs: int = 1) -> skbio.TreeNode:
     """ Builds a tree for features based on a gradient.
 
+    The mean niche of every feature along the gradient (see
+    ``gneiss.sort.mean_niche_estimator``) is computed once, by a sparse
+    matrix-vector product over the table, and is used both to cluster the
+    features and to sort the tree.
+
     Parameters
     ----------
-    table : pd.DataFrame
-       Contingency table where rows are samples and columns are features.
+    table : biom.Table
+       Contingency table where rows are features and columns are samples.
     gradient : qiime2.NumericMetadataColumn
        Continuous vector of measurements corresponding to samples.
     ignore_missing_samples: bool
@@ -85,30 +438,84 @@ def gradient_clustering(table: pd.DataFrame,
     weighted : bool
        Specifies if abundance or presence/absence information
        should be used to perform the clustering.
+    n_bootstraps : int
+       Number of bootstrap replicates of the samples from which the
+       support of the clades is estimated.
+    random_seed : int
+       Seed of the bootstrap replicates.
+    n_jobs : int
+       Number of processes that run the bootstrap replicates.
 
     Returns
     -------
     skbio.TreeNode
        Represents the partitioning of features with respect to the gradient.
+       With bootstrap replicates, the names of the internal nodes, except
+       the root, are prefixed with their support (see
+       ``correlation_clustering``).
+
+    Raises
+    ------
+    ValueError
+       Some features are not observed in any sample of the gradient.
     """
-    c = gradient.to_series()
+    mat, g, features, niche = _gradient_niches(
+        table, gradient.to_series().to_frame(), ignore_missing_samples,
+        weighted, 'gradient metadata column')
+    g, niche = g[:, 0], niche[:, 0]
+    mean_g = pd.Series(niche, index=features)
+    t = _rank_linkage(mean_g, method='average')
+    t = gradient_sort(t, mean_g, inplace=True)
+    if n_bootstraps:
+        nodes, clades = _tree_clades(t, features)
+        # features x samples, shared without densifying a sparse table
+        data = mat.T.tocsr() if issparse(mat) else np.ascontiguousarray(mat.T)
+        support = _bootstrap_support(clades, data, _gradient_replicate,
+                                     (g, niche, weighted), n_bootstraps,
+                                     seed=random_seed, n_jobs=n_jobs)
+        _label_support(nodes, support)
+    return t
+
+
+def _gradient_niches(table, gradients, ignore_missing_samples, weighted,
+                     source):
+    # samples x features matrix of the samples of `table` that are in the
+    # samples x gradients frame `gradients`, their gradient values, the
+    # features and their mean niches along every gradient
+    mat, samples, features = _matrix(table)
     if not ignore_missing_samples:
-        difference = set(table.index) - set(c.index)
+        difference = set(samples) - set(gradients.index)
         if difference:
             raise KeyError("There are samples present in the table not "
-                           "present in the gradient metadata column. Override "
+                           "present in the %s. Override "
                            "this error by using the `ignore_missing_samples` "
                            "argument. Offending samples: %r"
-                           % ', '.join(sorted([str(i) for i in difference])))
-    if not weighted:
-        table = (table > 0).astype(float)
-    table, c = match(table, c)
-    t = gradient_linkage(table, c, method='average')
-    mean_g = mean_niche_estimator(table, c)
-    mean_g = pd.Series(mean_g, index=table.columns)
-    mean_g = mean_g.sort_values()
-    t = gradient_sort(t, mean_g)
-    return t
+                           % (source,
+                              ', '.join(sorted([str(i) for i in difference]))))
+    ids, g = _align(samples, gradients)
+    if np.isnan(g).any():
+        if g.shape[1] == 1:
+            raise ValueError("`gradient` cannot have any nans.")
+        columns = gradients.columns[np.isnan(g).any(axis=0)]
+        raise ValueError('Gradients %s cannot have any nans.'
+                         % ', '.join(map(str, columns)))
+    mat = mat[ids]
+    niche = _mean_niche(mat, g, weighted)
+    missing = np.isnan(niche).any(axis=1)
+    if missing.any():
+        raise ValueError('Features %s are not observed in any sample of the '
+                         'gradient.' % ', '.join(
+                             map(str, np.asarray(features)[missing])))
+    return mat, g, features, niche
+
+
+def _gradient_replicate(data, ids, gradient, niche, weighted=True):
+    # linkage of a bootstrap replicate (see `_bootstrap_support`) of the
+    # features x samples `data`, dense or CSR.  Features absent from the
+    # replicate keep their mean niche in the whole table.
+    mean = _mean_niche(data[:, ids].T, gradient[ids], weighted)
+    mean = np.where(np.isnan(mean), niche, mean)
+    return average_linkage_1d(mean)
 
 
 plugin.methods.register_function(
@@ -122,12 +529,21 @@ plugin.methods.register_function(
                   'the columns will be clustered.'),
     },
     parameters={'gradient': MetadataColumn[Numeric], 'weighted': Bool,
-                'ignore_missing_samples': Bool},
+                'ignore_missing_samples': Bool,
+                'n_bootstraps': Int % Range(0, None),
+                'random_seed': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None)},
     parameter_descriptions={
         'gradient': ('Contains gradient values to sort the '
                      'features and samples.'),
         'weighted': ('Specifies if abundance or presence/absence '
                      'information should be used to perform the clustering.'),
+        'n_bootstraps': _n_bootstraps_description,
+        'random_seed': 'Seed of the bootstrap replicates.',
+        'n_jobs': ('Number of processes that run the bootstrap replicates.  '
+                   'The processes share the table through shared memory.  '
+                   'The support does not depend on the number of '
+                   'processes.'),
     },
     output_descriptions={
         'clustering': ('A hierarchy of feature identifiers where each tip '
@@ -144,6 +560,86 @@ plugin.methods.register_function(
 )
 
 
+def multi_gradient_clustering(table: biom.Table,
+                              gradients: qiime2.Metadata,
+                              ignore_missing_samples: bool = False,
+                              weighted: bool = True) -> skbio.TreeNode:
+    """ Builds a tree for features along every one of several gradients.
+
+    The table is aligned with the gradients once, and the mean niches of
+    the features along all the gradients are computed by a single matrix
+    product of the table with the samples x gradients matrix (see
+    ``gradient_clustering``).  Samples must have a value for every
+    gradient.
+
+    Parameters
+    ----------
+    table : biom.Table
+       Contingency table where rows are features and columns are samples.
+    gradients : qiime2.Metadata
+       Metadata whose numeric columns are the gradients.
+    ignore_missing_samples: bool
+        Whether to except or ignore when there are samples present in the table
+        that are not present in the gradient metadata.
+    weighted : bool
+       Specifies if abundance or presence/absence information
+       should be used to perform the clustering.
+
+    Returns
+    -------
+    dict of str to skbio.TreeNode
+       The tree of ``gradient_clustering`` for every numeric column,
+       keyed by its name.
+
+    Raises
+    ------
+    ValueError
+       The metadata has no numeric column.
+    """
+    gradients = gradients.filter_columns(column_type='numeric')
+    if not gradients.column_count:
+        raise ValueError('The metadata has no numeric column.')
+    gradients = gradients.to_dataframe()
+    _, _, features, niches = _gradient_niches(
+        table, gradients, ignore_missing_samples, weighted,
+        'gradient metadata')
+    res = {}
+    for name, niche in zip(gradients.columns, niches.T):
+        mean_g = pd.Series(niche, index=features)
+        t = _rank_linkage(mean_g, method='average')
+        res[name] = gradient_sort(t, mean_g, inplace=True)
+    return res
+
+
+plugin.methods.register_function(
+    function=multi_gradient_clustering,
+    inputs={
+        'table': FeatureTable[Frequency | RelativeFrequency | Composition]},
+    outputs=[('clusterings', Collection[Hierarchy])],
+    name='Hierarchical clustering along several gradients.',
+    input_descriptions={
+        'table': ('The feature table containing the samples in which '
+                  'the columns will be clustered.'),
+    },
+    parameters={'gradients': Metadata, 'weighted': Bool,
+                'ignore_missing_samples': Bool},
+    parameter_descriptions={
+        'gradients': ('Every numeric column is a gradient along which the '
+                      'features are clustered.  Samples must have a value '
+                      'for every numeric column.'),
+        'weighted': ('Specifies if abundance or presence/absence '
+                     'information should be used to perform the clustering.'),
+    },
+    output_descriptions={
+        'clusterings': ('The hierarchy of `gradient-clustering` along every '
+                        'gradient, keyed by the name of its column.')},
+    description=('Build the hierarchical clustering of `gradient-clustering` '
+                 'along every numeric column of the metadata.  The table is '
+                 'read once, and the mean gradients that the features are '
+                 'observed in are computed for all the columns at once.')
+)
+
+
 def assign_ids(input_table: pd.DataFrame,
                input_tree: skbio.TreeNode) -> (pd.DataFrame, skbio.TreeNode):
 
@@ -0,0 +1,410 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from q2_gneiss._util import (_BLOCK_ENTRIES, _log_pseudocount, _row_blocks,
+                             _shifted_log)
+
+
+# Most rows in a tile, so that there are tiles for every worker.
+_TILE_ROWS = 256
+
+
+def _profiles(mat, pseudocount=0.5, dtype=np.float64, distortion=None,
+              seed=0):
+    r""" Centered log profiles of the features of a table.
+
+    Returns the features x samples matrix :math:`p_i = (\ln x_i -
+    \overline{\ln x_i}) / \sqrt{2N}`, with :math:`N` samples, so that
+    :math:`\|p_i - p_j\|^2` is the variation :math:`V_{ij}` between
+    features :math:`i` and :math:`j` (see ``_profile_variation``).  A sparse
+    table is densified, since centered profiles are dense, unless it is
+    sketched: with a ``distortion``, the profiles are projected on fewer
+    dimensions (see ``_sketch``).
+    """
+    if issparse(mat):
+        if distortion is None:
+            mat = mat.toarray()
+        else:
+            profiles = _sketch(
+                _SparseProfiles.from_counts(mat, pseudocount, dtype=dtype),
+                distortion, seed)
+            if isinstance(profiles, _SparseProfiles):
+                profiles = profiles.toarray()
+            return profiles
+    profiles = np.array(np.transpose(mat), dtype=dtype, order='C')
+    profiles = _log_pseudocount(profiles, pseudocount, inplace=True,
+                                dtype=dtype)
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    profiles /= np.sqrt(2 * profiles.shape[1])
+    if distortion is not None:
+        profiles = _sketch(profiles, distortion, seed)
+    return profiles
+
+
+class _SparseProfiles:
+    r""" Centered log profiles of a sparse table, kept sparse.
+
+    With zeros replaced by the pseudocount :math:`c`, :math:`\ln x_i =
+    \ln c + s_i`, where :math:`s_i` (see ``_shifted_log``) is zero
+    wherever :math:`x_i` is.  The constant cancels in the centering, so
+    the inner products of the profiles (see ``_profiles``) are
+
+    .. math::
+        p_i \cdot p_j = \frac{s_i \cdot s_j - N \bar{s}_i \bar{s}_j}{2N}
+
+    a sparse product with a rank-one correction.
+
+    Parameters
+    ----------
+    logs : scipy.sparse.csr_matrix
+        Features x samples matrix of the shifted logs :math:`s_i`.
+    mean : np.ndarray
+        Mean shifted log of each feature.
+    """
+
+    def __init__(self, logs, mean):
+        self.logs = logs
+        self.mean = mean
+
+    @classmethod
+    def from_counts(cls, mat, pseudocount=0.5, dtype=np.float64):
+        """ Profiles of a samples x features sparse matrix of counts. """
+        logs = csr_matrix(_shifted_log(mat, pseudocount, dtype=dtype).T)
+        return cls(logs, np.asarray(logs.mean(axis=1), dtype=dtype).ravel())
+
+    @property
+    def shape(self):
+        return self.logs.shape
+
+    def gram(self, lo, hi):
+        """ Inner products of profiles ``lo:hi`` with profiles ``lo:``. """
+        n_samples = self.logs.shape[1]
+        tile = (self.logs[lo:hi] @ self.logs[lo:].T).toarray()
+        tile -= n_samples * np.outer(self.mean[lo:hi], self.mean[lo:])
+        tile /= 2 * n_samples
+        return tile
+
+    def sqnorm(self):
+        """ Squared norm of every profile. """
+        n_samples = self.logs.shape[1]
+        sq = np.asarray(self.logs.multiply(self.logs).sum(axis=1),
+                        dtype=self.mean.dtype).ravel()
+        sq -= n_samples * self.mean ** 2
+        sq /= 2 * n_samples
+        return sq
+
+    def project(self, proj, rows):
+        """ Product of the profiles, restricted to the samples in ``rows``,
+        with ``proj``, a matrix of as many rows.
+        """
+        n_samples = self.logs.shape[1]
+        res = np.asarray(self.logs[:, rows] @ proj, dtype=self.mean.dtype)
+        res -= np.outer(self.mean, proj.sum(axis=0))
+        res /= np.sqrt(2 * n_samples)
+        return res
+
+    def toarray(self):
+        """ The dense profiles (see ``_profiles``). """
+        n_samples = self.logs.shape[1]
+        dense = self.logs.toarray()
+        dense -= self.mean[:, None]
+        dense /= np.sqrt(2 * n_samples)
+        return dense
+
+
+def _gram(profiles, lo, hi):
+    # inner products of profiles lo:hi with profiles lo:
+    if isinstance(profiles, _SparseProfiles):
+        return profiles.gram(lo, hi)
+    return profiles[lo:hi] @ profiles[lo:].T
+
+
+def _sqnorm(profiles):
+    if isinstance(profiles, _SparseProfiles):
+        return profiles.sqnorm()
+    return np.einsum('ij,ij->i', profiles, profiles)
+
+
+def _sketch_dim(n, distortion):
+    """ Dimension of a random projection that keeps the squared distances
+    between ``n`` points within a factor ``1 +/- distortion`` of their
+    value with high probability (Dasgupta and Gupta's bound on the
+    Johnson-Lindenstrauss lemma).  It depends on ``n`` only
+    logarithmically, and not at all on the original dimension.
+    """
+    if not 0 < distortion < 1:
+        raise ValueError('`distortion` must be between 0 and 1, not %r.'
+                         % distortion)
+    bound = distortion ** 2 / 2 - distortion ** 3 / 3
+    return max(1, int(np.ceil(4 * np.log(max(n, 2)) / bound)))
+
+
+def _sketch(profiles, distortion, seed=0):
+    """ Johnson-Lindenstrauss sketch of the profiles of the features.
+
+    The profiles are multiplied by a samples x k gaussian matrix with
+    entries of variance 1 / k, with k from ``_sketch_dim``, so the
+    squared distances between features, i.e. their variations, are
+    preserved within a factor ``1 +/- distortion``, and every later
+    distance costs O(k) instead of O(samples).  The projection is drawn
+    ``_BLOCK_ENTRIES`` at a time from ``seed`` and applied to the samples
+    it covers, so it is never held in full.  Sparse profiles stay sparse
+    (see ``_SparseProfiles.project``).  The profiles are returned as they
+    are if k is not smaller than the number of samples.
+
+    Parameters
+    ----------
+    profiles : np.ndarray or _SparseProfiles
+        Features x samples profiles.
+    distortion : float
+        Largest relative error of the squared distances, in (0, 1).
+    seed : int
+        Seed of the projection.
+
+    Returns
+    -------
+    np.ndarray
+        Features x k sketched profiles.
+    """
+    n, n_samples = profiles.shape
+    k = _sketch_dim(n, distortion)
+    if k >= n_samples:
+        return profiles
+    dtype = (profiles.mean.dtype if isinstance(profiles, _SparseProfiles)
+             else profiles.dtype)
+    state = np.random.RandomState(seed)
+    if isinstance(profiles, _SparseProfiles):
+        profiles = _SparseProfiles(profiles.logs.tocsc(), profiles.mean)
+    sketch = np.zeros((n, k), dtype=dtype)
+    for rows in _row_blocks(n_samples, max(1, _BLOCK_ENTRIES // k)):
+        proj = state.standard_normal((rows.stop - rows.start, k))
+        proj = (proj / np.sqrt(k)).astype(dtype, copy=False)
+        if isinstance(profiles, _SparseProfiles):
+            sketch += profiles.project(proj, rows)
+        else:
+            sketch += profiles[:, rows] @ proj
+    return sketch
+
+
+def _condensed_offset(i, n):
+    """ Position of the distance between ``i`` and ``i + 1`` in a condensed
+    matrix of ``n`` observations.  The distances between ``i`` and all of
+    ``j > i`` follow it contiguously.
+    """
+    return n * i - i * (i + 1) // 2
+
+
+def _variation_rows(profiles, sqnorm, rows, out):
+    """ Writes the variations between the features in ``rows`` and all of
+    the features after them into the condensed buffer ``out``.
+    """
+    n = profiles.shape[0]
+    lo, hi = rows.start, rows.stop
+    tile = _gram(profiles, lo, hi)
+    tile *= -2
+    tile += sqnorm[lo:hi, None]
+    tile += sqnorm[None, lo:]
+    # rounding may leave tiny negative distances between nearly
+    # proportional features
+    np.maximum(tile, 0, out=tile)
+    for i in range(lo, hi):
+        start = _condensed_offset(i, n)
+        out[start:start + n - i - 1] = tile[i - lo, i - lo + 1:]
+
+
+class _SharedArray:
+    """ An array in a block of shared memory, which other processes attach
+    to by name (see ``attach``) instead of receiving a pickled copy.
+
+    The process that creates the block unlinks it on ``close``.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        dtype = np.dtype(dtype)
+        self._owner = name is None
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self._shm = SharedMemory(name=name, create=self._owner, size=size)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self.spec = (self._shm.name, tuple(shape), dtype.str)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _share(profiles):
+    # copies the profiles (or any CSR or dense matrix) into shared memory;
+    # returns the shared arrays and the spec from which `_attach` rebuilds
+    # them
+    if isinstance(profiles, _SparseProfiles):
+        logs = profiles.logs
+        arrays = [logs.data, logs.indices, logs.indptr, profiles.mean]
+        kind = 'sparse'
+    elif issparse(profiles):
+        profiles = profiles.tocsr()
+        arrays = [profiles.data, profiles.indices, profiles.indptr]
+        kind = 'csr'
+    else:
+        kind = 'dense'
+        arrays = [profiles]
+    shared = []
+    try:
+        for a in arrays:
+            shared.append(_SharedArray(a.shape, a.dtype))
+            shared[-1].array[:] = a
+    except BaseException:
+        for s in shared:
+            s.close()
+        raise
+    return shared, (kind, [s.spec for s in shared], profiles.shape)
+
+
+def _attach(spec):
+    kind, specs, shape = spec
+    shared = [_SharedArray.attach(s) for s in specs]
+    arrays = [s.array for s in shared]
+    if kind == 'sparse':
+        logs = csr_matrix(tuple(arrays[:3]), shape=shape)
+        return shared, _SparseProfiles(logs, arrays[3])
+    if kind == 'csr':
+        return shared, csr_matrix(tuple(arrays), shape=shape)
+    return shared, arrays[0]
+
+
+# Shared arrays of a worker process of ``_profile_variation``.
+_worker = {}
+
+
+def _init_worker(profiles_spec, out_spec):
+    shared, profiles = _attach(profiles_spec)
+    if out_spec[0] == 'file':
+        _, filename, shape, dtype = out_spec
+        out = np.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+    else:
+        shared.append(_SharedArray.attach(out_spec))
+        out = shared[-1].array
+    _worker['shared'] = shared
+    _worker['profiles'] = profiles
+    _worker['sqnorm'] = _sqnorm(profiles)
+    _worker['out'] = out
+
+
+def _worker_rows(rows):
+    _variation_rows(_worker['profiles'], _worker['sqnorm'], rows,
+                    _worker['out'])
+
+
+def _parallel_variation(profiles, blocks, out, n_jobs, progress=None):
+    # The profiles, and the output unless it is a file, are placed in
+    # shared memory that the workers attach to once, so every task only
+    # sends a slice of rows.
+    shared, profiles_spec = _share(profiles)
+    try:
+        if isinstance(out, np.memmap) and out.filename is not None:
+            out.flush()
+            out_spec = ('file', out.filename, out.shape, out.dtype.str)
+            shared_out = None
+        else:
+            shared_out = _SharedArray(out.shape, out.dtype)
+            shared.append(shared_out)
+            out_spec = shared_out.spec
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_worker,
+                                 initargs=(profiles_spec, out_spec)) as pool:
+            for i, _ in enumerate(pool.map(_worker_rows, blocks)):
+                if progress is not None:
+                    progress(i)
+        if shared_out is not None:
+            out[:] = shared_out.array
+    finally:
+        for s in shared:
+            s.close()
+
+
+def _profile_variation(profiles, out=None, n_jobs=1, start=0,
+                       progress=None):
+    r""" Condensed Aitchison variation matrix of the features of a table,
+    from their profiles.
+
+    The squared euclidean distance between the profiles (see ``_profiles``
+    and ``_SparseProfiles``) of features :math:`i` and :math:`j` is
+
+    .. math::
+        V_{ij} = \frac{1}{2} var(\ln x_i - \ln x_j)
+               = \frac{1}{2} (var_i + var_j - 2 cov_{ij})
+
+    like ``gneiss.composition.variation_matrix`` (the closure cancels in
+    the log-ratio), but the pairwise variances are read off the Gram
+    matrix of the profiles.  It is computed one tile of rows at a time
+    with a matrix product against the features that follow them, and
+    each tile is written into the condensed output, so the square matrix
+    is never formed.  Sparse profiles are never densified either.
+
+    With ``n_jobs`` greater than one, the tiles are computed by a pool of
+    processes that share the profiles and the output through
+    ``multiprocessing.shared_memory`` (or, if ``out`` is a file-backed
+    ``np.memmap``, through the file).  The tiles do not depend on
+    ``n_jobs``.
+
+    Parameters
+    ----------
+    profiles : np.ndarray or _SparseProfiles
+        Features x samples profiles, possibly sketched (see ``_sketch``).
+    out : np.ndarray, optional
+        Condensed buffer to write the distances into (default of the type
+        of the profiles).
+    n_jobs : int
+        Number of processes computing the tiles.
+    start : int
+        First tile to compute; the tiles before it are already in ``out``.
+    progress : callable, optional
+        Called with ``i`` once tile ``i`` and all of the tiles before it
+        are written.
+
+    Returns
+    -------
+    np.ndarray
+        Condensed distances (see ``scipy.spatial.distance.squareform``).
+    """
+    if n_jobs < 1:
+        raise ValueError('`n_jobs` must be positive, not %r.' % n_jobs)
+    n = profiles.shape[0]
+    if out is None:
+        dtype = (profiles.mean.dtype
+                 if isinstance(profiles, _SparseProfiles) else profiles.dtype)
+        out = np.empty(n * (n - 1) // 2, dtype=dtype)
+    blocks = _row_blocks(n, _tile_rows(n))
+    if progress is None:
+        def progress(i):
+            pass
+    if n_jobs > 1 and len(blocks) - start > 1:
+        _parallel_variation(profiles, blocks[start:], out, n_jobs,
+                            lambda i: progress(start + i))
+        return out
+    sqnorm = _sqnorm(profiles)
+    for i, rows in enumerate(blocks[start:], start):
+        _variation_rows(profiles, sqnorm, rows, out)
+        progress(i)
+    return out
+
+
+def _tile_rows(n):
+    # rows in a tile of the variation matrix of n features
+    return max(1, min(_TILE_ROWS, _BLOCK_ENTRIES // max(1, n)))
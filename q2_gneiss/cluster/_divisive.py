@@ -0,0 +1,174 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import numpy as np
+import skbio
+
+from q2_gneiss._util import _parallel_map
+from q2_gneiss.cluster._distance import _SparseProfiles
+
+
+# Most features of a node whose principal component is computed exactly,
+# from the eigenvectors of their Gram matrix, rather than by power
+# iteration.
+_EXACT_FEATURES = 64
+# Most entries of the sparse profiles of a node that are densified, since
+# sparse products carry a large overhead on small matrices.
+_DENSE_ENTRIES = 2 ** 16
+
+
+def _subset(profiles, ids):
+    if isinstance(profiles, _SparseProfiles):
+        sub = _SparseProfiles(profiles.logs[ids], profiles.mean[ids])
+        if len(ids) * sub.shape[1] <= _DENSE_ENTRIES:
+            return sub.toarray()
+        return sub
+    return profiles[ids]
+
+
+def _matvec(profiles, v):
+    # product of the features x samples profiles with a vector of samples
+    if isinstance(profiles, _SparseProfiles):
+        n_samples = profiles.shape[1]
+        res = profiles.logs @ v - profiles.mean * v.sum()
+        return res / np.sqrt(2 * n_samples)
+    return profiles @ v
+
+
+def _rmatvec(profiles, u):
+    # product of a vector of features with the features x samples profiles
+    if isinstance(profiles, _SparseProfiles):
+        n_samples = profiles.shape[1]
+        res = profiles.logs.T @ u - profiles.mean @ u
+        return res / np.sqrt(2 * n_samples)
+    return u @ profiles
+
+
+def _principal_split(profiles, n_iter=5, seed=0):
+    """ Splits features by the sign of their leading principal component.
+
+    The profiles are centered over the features, and the leading right
+    singular vector of the centered matrix is approximated by ``n_iter``
+    power iterations from a random start, without forming the centered
+    matrix nor any covariance matrix.  Up to ``_EXACT_FEATURES``
+    features, the principal component is instead read off the leading
+    eigenvector of the Gram matrix of the centered profiles.  Features on
+    either side of the mean along that direction form the two parts; the
+    direction is oriented so that the feature farthest from the mean is on
+    the positive side, so the split does not depend on the arbitrary sign
+    of the eigenvector, nor on the order of the features.  If
+    every feature falls on the same side (e.g. identical profiles), the
+    features are split at the median instead, so that both parts are
+    never empty.
+
+    Parameters
+    ----------
+    profiles : np.ndarray or _SparseProfiles
+        Features x samples profiles (see ``_profiles``) of at least two
+        features.
+    n_iter : int
+        Number of power iterations.
+    seed : int or sequence of int
+        Seed of the starting vector.
+
+    Returns
+    -------
+    np.ndarray
+        Whether every feature is on the positive side.
+    """
+    n, n_samples = profiles.shape
+    if n == 2:
+        return np.array([False, True])
+    if n <= _EXACT_FEATURES:
+        if isinstance(profiles, _SparseProfiles):
+            profiles = profiles.toarray()
+        centered = profiles - profiles.mean(axis=0)
+        values, vectors = np.linalg.eigh(centered @ centered.T)
+        scores = vectors[:, -1] * np.sqrt(max(values[-1], 0))
+    else:
+        mean = _rmatvec(profiles, np.full(n, 1 / n))
+        v = np.random.RandomState(seed).standard_normal(n_samples)
+        for _ in range(n_iter):
+            u = _matvec(profiles, v) - mean @ v
+            v = _rmatvec(profiles, u) - mean * u.sum()
+            norm = np.linalg.norm(v)
+            if norm == 0:
+                break
+            v /= norm
+        scores = _matvec(profiles, v) - mean @ v
+    # the sign of a principal component is arbitrary: orient it so that the
+    # feature farthest from the mean (the first one on ties) is positive
+    if scores[np.argmax(np.abs(scores))] < 0:
+        scores = -scores
+    positive = scores > 0
+    if positive.all() or not positive.any():
+        positive[:] = False
+        positive[np.argsort(scores, kind='stable')[n // 2:]] = True
+    return positive
+
+
+def _divisive_tree(profiles, features, n_iter=5, seed=0, n_jobs=1):
+    """ Hierarchy built top-down by principal splits of the features.
+
+    Every node is split by ``_principal_split`` into a denominator (the
+    features on the negative side) and a numerator (those on the positive
+    side), until single features are left.  The nodes of a level of the
+    tree are independent, so they are split on ``n_jobs`` threads, and
+    the profiles of every part are copied from those of its parent, so a
+    level holds one copy of the profiles.  Every
+    node draws its starting vector from ``seed`` and its position in the
+    level order of the tree, so the tree does not depend on ``n_jobs``.
+    A level costs O(n_iter * features * samples); the depth of the tree
+    is logarithmic in the number of features when the splits are
+    balanced.
+
+    Parameters
+    ----------
+    profiles : np.ndarray or _SparseProfiles
+        Features x samples profiles (see ``_profiles``).
+    features : list of str
+        Names of the features.
+    n_iter : int
+        Number of power iterations per split.
+    seed : int
+        Seed of the starting vectors.
+    n_jobs : int
+        Number of threads splitting the nodes of a level.
+
+    Returns
+    -------
+    skbio.TreeNode
+        Bifurcating tree without internal node names nor branch lengths.
+    """
+    root = skbio.TreeNode()
+    level = [(root, np.arange(profiles.shape[0]), profiles, 0)]
+    n_nodes = 1
+
+    def _split(item):
+        _, ids, block, node_id = item
+        positive = _principal_split(block, n_iter, seed=[seed, node_id])
+        parts = []
+        for side in (~positive, positive):
+            side = np.flatnonzero(side)
+            parts.append((ids[side],
+                          _subset(block, side) if len(side) > 1 else None))
+        return parts
+
+    while level:
+        splits = _parallel_map(_split, level, n_jobs)
+        next_level = []
+        for (node, *_), parts in zip(level, splits):
+            for part, block in parts:
+                if len(part) == 1:
+                    node.append(skbio.TreeNode(name=features[part[0]]))
+                    continue
+                child = skbio.TreeNode()
+                node.append(child)
+                next_level.append((child, part, block, n_nodes))
+                n_nodes += 1
+        level = next_level
+    return root
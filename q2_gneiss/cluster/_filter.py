@@ -0,0 +1,58 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import numpy as np
+
+from q2_gneiss._util import _shifted_log
+
+
+def _column_sums(mat):
+    return np.asarray(mat.sum(axis=0), dtype=np.float64).ravel()
+
+
+def _feature_filter(mat, pseudocount=0.5, min_prevalence=0.0,
+                    min_total_count=0, top_k_var=None):
+    """ Features of a table that pass prevalence, count and variance
+    filters.
+
+    The prevalence and the total count of every feature are read off the
+    table in one reduction each, and features below either threshold are
+    dropped.  Of the remaining features, the ``top_k_var`` with the
+    largest variance of their logs (with zeros replaced by
+    ``pseudocount``) are kept.  The variance is computed from the shifted
+    logs (see ``_shifted_log``), so a sparse table stays sparse.
+
+    Parameters
+    ----------
+    mat : np.ndarray or scipy.sparse.spmatrix
+        Samples x features matrix of counts.
+    pseudocount : float
+        The value that replaces zero counts.
+    min_prevalence : float
+        Smallest fraction of the samples in which a feature is observed.
+    min_total_count : int
+        Smallest total count of a feature across samples.
+    top_k_var : int, optional
+        Number of the most variable features to keep.
+
+    Returns
+    -------
+    np.ndarray
+        Positions of the kept features, in table order.
+    """
+    n_samples = mat.shape[0]
+    keep = ((_column_sums(mat > 0) >= min_prevalence * n_samples) &
+            (_column_sums(mat) >= min_total_count))
+    ids = np.flatnonzero(keep)
+    if top_k_var is None or top_k_var >= len(ids):
+        return ids
+    logs = _shifted_log(mat[:, ids], pseudocount)
+    mean = _column_sums(logs) / n_samples
+    var = _column_sums(logs.multiply(logs) if hasattr(logs, 'multiply')
+                       else logs * logs) / n_samples - mean ** 2
+    top = np.argpartition(-var, top_k_var - 1)[:top_k_var]
+    return ids[np.sort(top)]
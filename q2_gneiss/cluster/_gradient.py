@@ -0,0 +1,103 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse
+
+from q2_gneiss._util import _BLOCK_ENTRIES, _row_blocks
+
+
+def _align(samples, gradient):
+    """ Positions and gradient values of the samples of a table that are
+    in ``gradient`` (a series, or a samples x gradients frame), sorted by
+    sample id.
+
+    Like ``gneiss.util.match``, the samples are the intersection of those
+    of the table and of the gradient, but their order does not depend on
+    the hash seed, so bootstrap replicates drawn from them are
+    reproducible.
+
+    Raises
+    ------
+    ValueError
+        ``gradient`` has duplicate sample ids, or no sample is shared.
+    """
+    if not gradient.index.is_unique:
+        raise ValueError("`metadata` has duplicate sample ids.")
+    samples = pd.Index(samples)
+    ids = np.flatnonzero(samples.isin(gradient.index))
+    if len(ids) == 0:
+        raise ValueError("No more samples left.  Check to make sure that "
+                         "the sample names between `metadata` and `table` "
+                         "are consistent")
+    ids = ids[np.argsort(samples[ids], kind='stable')]
+    return ids, gradient.loc[samples[ids]].values.astype(np.float64)
+
+
+def _presence_niche(mat, gradient):
+    # mean niche of presence / absence, from blocks of the sparsity pattern
+    # of a sparse table, or of boolean rows of a dense one, so that no
+    # float copy of the table is made
+    n_samples, n_features = mat.shape
+    total = np.zeros(n_features)
+    weighted = np.zeros((n_features,) + gradient.shape[1:])
+    if issparse(mat):
+        mat = mat.tocsr()
+        step = max(1, _BLOCK_ENTRIES * n_samples // max(1, mat.nnz))
+    else:
+        step = max(1, _BLOCK_ENTRIES // max(1, n_features))
+    for rows in _row_blocks(n_samples, step):
+        block = mat[rows]
+        if issparse(block):
+            present = csr_matrix((block.data > 0, block.indices,
+                                  block.indptr), shape=block.shape)
+        else:
+            present = block > 0
+        total += np.asarray(present.sum(axis=0)).ravel()
+        weighted += present.T @ gradient[rows]
+    return weighted, total
+
+
+def _mean_niche(mat, gradient, weighted=True):
+    """ Mean niche of every feature along one or more gradients.
+
+    The mean niche of a feature is the average of a gradient over the
+    samples, weighted by the abundances of the feature, as in
+    ``gneiss.sort.mean_niche_estimator``.  It is computed for all the
+    features and gradients at once as ``gradient.T @ mat / mat.sum(0)``,
+    which is a single matrix product over a sparse table, without
+    normalizing nor densifying it.  Without weights, only the presence of
+    the features counts: the sums are taken over blocks of the sparsity
+    pattern of a sparse table (or of boolean rows of a dense one), so
+    presence / absence takes no more memory than the table.
+
+    Parameters
+    ----------
+    mat : np.ndarray or scipy.sparse.spmatrix
+        Samples x features matrix of abundances.
+    gradient : np.ndarray
+        Gradient value of every sample, or samples x gradients values.
+    weighted : bool
+        Whether the samples are weighted by the abundances, rather than by
+        the presence, of the features.
+
+    Returns
+    -------
+    np.ndarray
+        Mean niche of every feature (nan for features that are never
+        observed), or features x gradients mean niches.
+    """
+    if weighted:
+        total = np.asarray(mat.sum(axis=0), dtype=np.float64).ravel()
+        mean = np.asarray(mat.T @ gradient, dtype=np.float64)
+    else:
+        mean, total = _presence_niche(mat, gradient)
+    if mean.ndim == 2:
+        total = total[:, None]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return mean / total
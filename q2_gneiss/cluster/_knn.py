@@ -0,0 +1,195 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import heapq
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def _rp_leaves(X, leaf_size, state):
+    """ Leaves of a random projection tree over the rows of ``X``.
+
+    Every node projects its points on a random direction and splits them
+    at the median, so the tree is balanced whatever the ties.
+    """
+    stack = [np.arange(X.shape[0])]
+    while stack:
+        points = stack.pop()
+        if len(points) <= leaf_size:
+            yield points
+            continue
+        direction = state.standard_normal(X.shape[1])
+        order = np.argsort(X[points] @ direction, kind='stable')
+        half = len(points) // 2
+        stack.append(points[order[half:]])
+        stack.append(points[order[:half]])
+
+
+def _rp_knn(X, n_neighbors, n_trees=10, leaf_size=None, seed=0):
+    """ Approximate nearest neighbors of the rows of ``X``.
+
+    The candidate neighbors of a point are the other points that share a
+    leaf with it in any of ``n_trees`` random projection trees; the
+    ``n_neighbors`` closest of them are kept.  The cost is
+    O(n_trees * n * leaf_size) distances instead of O(n^2).
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Observations x dimensions matrix.
+    n_neighbors : int
+        Number of neighbors of every observation.
+    n_trees : int
+        Number of random projection trees.
+    leaf_size : int, optional
+        Most points in a leaf (default ``max(2 * n_neighbors, 32)``).
+    seed : int
+        Seed of the random directions.
+
+    Returns
+    -------
+    np.ndarray
+        Observations x n_neighbors indices of the neighbors, closest first
+        (-1 where fewer candidates were found).
+    np.ndarray
+        Squared euclidean distances to those neighbors.
+    """
+    n = X.shape[0]
+    if leaf_size is None:
+        leaf_size = max(2 * n_neighbors, 32)
+    state = np.random.RandomState(seed)
+    sqnorm = np.einsum('ij,ij->i', X, X)
+    ids = np.full((n, n_neighbors), -1, dtype=np.intp)
+    dist = np.full((n, n_neighbors), np.inf)
+    for _ in range(n_trees):
+        for leaf in _rp_leaves(X, leaf_size, state):
+            d = X[leaf] @ X[leaf].T
+            d *= -2
+            d += sqnorm[leaf, None]
+            d += sqnorm[None, leaf]
+            np.maximum(d, 0, out=d)
+            np.fill_diagonal(d, np.inf)
+            # merge the leaf with the current neighbors, dropping the
+            # candidates that are already neighbors
+            cand_ids = np.hstack([ids[leaf],
+                                  np.broadcast_to(leaf, (len(leaf),
+                                                         len(leaf)))])
+            cand_dist = np.hstack([dist[leaf], d])
+            order = np.argsort(cand_ids, axis=1, kind='stable')
+            cand_ids = np.take_along_axis(cand_ids, order, axis=1)
+            cand_dist = np.take_along_axis(cand_dist, order, axis=1)
+            dup = np.zeros(cand_ids.shape, dtype=bool)
+            dup[:, 1:] = cand_ids[:, 1:] == cand_ids[:, :-1]
+            cand_dist[dup | (cand_ids < 0)] = np.inf
+            best = np.argsort(cand_dist, axis=1,
+                              kind='stable')[:, :n_neighbors]
+            dist[leaf] = np.take_along_axis(cand_dist, best, axis=1)
+            ids[leaf] = np.where(np.isinf(dist[leaf]), -1,
+                                 np.take_along_axis(cand_ids, best, axis=1))
+    return ids, dist
+
+
+def _knn_ward(X, neighbors, n_exact=None):
+    """ Ward linkage of the rows of ``X`` restricted to a neighbor graph.
+
+    Only clusters joined by an edge of the (symmetrized) graph are
+    candidates for a merge, and the edges of merged clusters are
+    united, so every step only updates the Ward distances of the new
+    cluster to its neighbors.  Once ``n_exact`` clusters are left, or no
+    edge is left between them, the constraint is lifted and they are
+    merged with unconstrained Ward: the graph only captures the local
+    structure, and O(n_exact^2) pairs are cheap.  Heights are made
+    monotone, so the hierarchy has nonnegative branch lengths.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Observations x dimensions matrix.
+    neighbors : np.ndarray
+        Observations x k indices of the neighbors of every observation
+        (-1 for none), e.g. from ``_rp_knn``.
+    n_exact : int, optional
+        Number of clusters from which on every pair is a candidate
+        (default ``2 * sqrt(n)``).
+
+    Returns
+    -------
+    np.ndarray
+        Linkage matrix (see ``scipy.cluster.hierarchy.linkage``).
+    """
+    n = X.shape[0]
+    if n_exact is None:
+        n_exact = int(2 * np.sqrt(n))
+    rows = np.repeat(np.arange(n), neighbors.shape[1])
+    cols = neighbors.ravel()
+    valid = cols >= 0
+    graph = csr_matrix((np.ones(valid.sum()), (rows[valid], cols[valid])),
+                       shape=(n, n))
+    graph = (graph + graph.T).tocsr()
+
+    # clusters are numbered like in a linkage matrix; cluster c is stored
+    # in row slot[c] of the centroids
+    centroids = np.array(X, dtype=np.float64)
+    slot = np.arange(2 * n - 1)
+    size = np.ones(2 * n - 1)
+    height = np.zeros(2 * n - 1)
+    alive = np.zeros(2 * n - 1, dtype=bool)
+    alive[:n] = True
+    edges = [set(graph.indices[graph.indptr[i]:graph.indptr[i + 1]].tolist())
+             for i in range(n)]
+    edges.extend(set() for _ in range(n - 1))
+
+    def ward(c, others):
+        diff = centroids[slot[others]] - centroids[slot[c]]
+        w = 2 * size[others] * size[c] / (size[others] + size[c])
+        return np.sqrt(w * np.einsum('ij,ij->i', diff, diff))
+
+    heap = []
+
+    def push(c, others):
+        others = np.fromiter(others, dtype=np.intp, count=len(others))
+        for o, d in zip(others.tolist(), ward(c, others).tolist()):
+            heapq.heappush(heap, (d, min(c, o), max(c, o)))
+
+    for i in range(n):
+        push(i, [j for j in edges[i] if j > i])
+
+    Z = np.empty((n - 1, 4))
+    exact = False
+    for k in range(n - 1):
+        while True:
+            if not exact and (not heap or n - k <= n_exact):
+                # from now on, every pair of clusters is a candidate
+                exact = True
+                rest = np.flatnonzero(alive)
+                for c in rest.tolist():
+                    edges[c].update(rest.tolist())
+                    edges[c].discard(c)
+                    push(c, rest[rest > c])
+            d, a, b = heapq.heappop(heap)
+            if alive[a] and alive[b]:
+                break
+        c = n + k
+        slot[c] = slot[a]
+        centroids[slot[c]] *= size[a]
+        centroids[slot[c]] += size[b] * centroids[slot[b]]
+        size[c] = size[a] + size[b]
+        centroids[slot[c]] /= size[c]
+        height[c] = max(d, height[a], height[b])
+        alive[a] = alive[b] = False
+        alive[c] = True
+        Z[k] = a, b, height[c], size[c]
+        edges[c] = (edges[a] | edges[b]) - {a, b}
+        edges[a] = edges[b] = None
+        for o in edges[c]:
+            edges[o].discard(a)
+            edges[o].discard(b)
+            edges[o].add(c)
+        if edges[c]:
+            push(c, edges[c])
+    return Z
@@ -0,0 +1,209 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import numpy as np
+
+from q2_gneiss._util import _BLOCK_ENTRIES, _row_blocks
+
+
+def _relabel(Z, n):
+    """ Sorts merges by height and renames clusters like scipy does.
+
+    ``Z[:, :2]`` holds, for every merge, the indices of one point of each
+    merged cluster.  After sorting, the ``i``-th merge creates cluster
+    ``n + i`` and refers to its children by their cluster ids.
+    """
+    Z = Z[np.argsort(Z[:, 2], kind='mergesort')]
+    parent = np.arange(2 * n - 1)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for i in range(n - 1):
+        x, y = find(int(Z[i, 0])), find(int(Z[i, 1]))
+        Z[i, 0], Z[i, 1] = min(x, y), max(x, y)
+        parent[x] = parent[y] = n + i
+    return Z
+
+
+def _vector_ward(X):
+    """ Ward linkage of the rows of ``X``, without any pairwise matrix.
+
+    The Ward distance between two clusters only depends on their sizes and
+    centroids,
+
+    .. math::
+        d(A, B) = \\sqrt{\\frac{2 |A| |B|}{|A| + |B|}} \\|\\mu_A - \\mu_B\\|
+
+    so the nearest neighbor chain algorithm can query the neighbors of a
+    cluster from the centroids directly.  Memory is that of the centroids
+    (a copy of ``X``) plus O(n) workspace; time is O(n^2) vector distances.
+    This is the same linkage as ``scipy.cluster.hierarchy.linkage(X,
+    'ward')``.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Observations x dimensions matrix.
+
+    Returns
+    -------
+    np.ndarray
+        Linkage matrix (see ``scipy.cluster.hierarchy.linkage``).
+    """
+    n = X.shape[0]
+    centroids = np.array(X)
+    size = np.ones(n)
+    active = np.ones(n, dtype=bool)
+    sqdist = np.empty(n)
+    blocks = _row_blocks(n, max(1, _BLOCK_ENTRIES // max(1, X.shape[1])))
+    Z = np.empty((n - 1, 4))
+    chain = []
+    for k in range(n - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            x = chain[-1]
+            for rows in blocks:
+                diff = centroids[rows] - centroids[x]
+                sqdist[rows] = np.einsum('ij,ij->i', diff, diff)
+            dist = 2 * size * size[x] / (size + size[x]) * sqdist
+            dist[~active] = np.inf
+            dist[x] = np.inf
+            y = int(np.argmin(dist))
+            # prefer the previous link on ties, so that the chain ends
+            if len(chain) > 1 and dist[chain[-2]] <= dist[y]:
+                y = chain[-2]
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+        height = np.sqrt(dist[y])
+        chain.pop()
+        chain.pop()
+        x, y = min(x, y), max(x, y)
+        # the merged cluster is stored in the slot of y
+        centroids[y] *= size[y]
+        centroids[y] += size[x] * centroids[x]
+        size[y] += size[x]
+        centroids[y] /= size[y]
+        active[x] = False
+        Z[k] = x, y, height, size[y]
+    return _relabel(Z, n)
+
+
+def _matrix_ward(dist, n, journal=None):
+    """ Ward linkage of a condensed distance matrix, updated in place.
+
+    This is the nearest neighbor chain algorithm of
+    ``scipy.cluster.hierarchy.linkage(dist, 'ward')``, with the same tie
+    breaking and the same Lance-Williams update, but the distances between
+    clusters overwrite ``dist`` itself instead of a float64 copy of it.
+    ``dist`` may thus be a ``np.memmap`` of any floating point type; only
+    O(n) float64 workspace is held in memory.  The contents of ``dist`` are
+    destroyed.
+
+    The distances of a cluster ``x`` to the clusters before it are spread
+    over the whole condensed matrix, one per condensed row, so every row
+    read and every update touches O(n) pages of ``dist``.  A memory mapped
+    ``dist`` is thus only fast while it fits in the page cache, which
+    saves the float64 copy of scipy but does not link matrices larger than
+    the memory of the machine in practical time: beyond that, every merge
+    reads O(n) pages from disk.
+
+    A ``journal`` makes the linkage resumable (see
+    ``q2_gneiss.cluster._checkpoint._Checkpoint``): ``journal.resume()``
+    returns the state from which to continue, if any; every merge ``k``
+    calls ``journal.before(k, positions, values)`` with the distances it
+    is about to overwrite, and then ``journal.after(k + 1, Z, size,
+    active, chain)`` with the state after it.
+
+    Parameters
+    ----------
+    dist : np.ndarray
+        Condensed distances between ``n`` observations.
+    n : int
+        Number of observations.
+    journal : object, optional
+        Journal of the merges.
+
+    Returns
+    -------
+    np.ndarray
+        Linkage matrix (see ``scipy.cluster.hierarchy.linkage``).
+    """
+    ids = np.arange(n)
+    offsets = n * ids - ids * (ids + 1) // 2
+    size = np.ones(n)
+    active = np.ones(n, dtype=bool)
+
+    def index(x):
+        # condensed positions of the distances between x and every i != x
+        # (the position for x itself is a placeholder)
+        pos = np.empty(n, dtype=np.int64)
+        pos[:x] = offsets[:x] + x - ids[:x] - 1
+        pos[x] = 0
+        pos[x + 1:] = offsets[x] + ids[x + 1:] - x - 1
+        return pos
+
+    def row(x):
+        d = np.empty(n)
+        d[:x] = dist[index(x)[:x]]
+        d[x + 1:] = dist[offsets[x]:offsets[x] + n - x - 1]
+        d[x] = np.inf
+        d[~active] = np.inf
+        return d
+
+    Z = np.empty((n - 1, 4))
+    chain = []
+    start = 0
+    state = None if journal is None else journal.resume()
+    if state is not None:
+        start, merges, size[:], active[:], chain = state
+        Z[:start] = merges
+    for k in range(start, n - 1):
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        while True:
+            x = chain[-1]
+            d = row(x)
+            y = int(np.argmin(d))
+            # only a strictly closer cluster replaces the previous link
+            if len(chain) > 1 and not d[y] < d[chain[-2]]:
+                y = chain[-2]
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+        height = d[y]
+        chain.pop()
+        chain.pop()
+        x, y = min(x, y), max(x, y)
+        nx, ny = size[x], size[y]
+        Z[k] = x, y, height, nx + ny
+        d_x, d_y = row(x), row(y)
+        active[x] = False
+        size[x] = 0
+        size[y] = nx + ny
+        update = active.copy()
+        update[y] = False
+        ni = size[update]
+        t = 1.0 / (nx + ny + ni)
+        d_xi, d_yi = d_x[update], d_y[update]
+        new = np.sqrt((ni + nx) * t * d_xi * d_xi +
+                      (ni + ny) * t * d_yi * d_yi -
+                      ni * t * height * height)
+        pos = index(y)[update]
+        if journal is not None:
+            journal.before(k, pos, dist[pos])
+        dist[pos] = new
+        if journal is not None:
+            journal.after(k + 1, Z, size, active, chain)
+    return _relabel(Z, n)
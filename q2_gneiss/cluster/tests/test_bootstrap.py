@@ -0,0 +1,112 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import csr_matrix, issparse
+from skbio import TreeNode
+
+from q2_gneiss.cluster._bootstrap import (_bootstrap_support, _label_support,
+                                          _linkage_clades, _resample,
+                                          _tree_clades)
+from q2_gneiss.cluster._distance import _SparseProfiles, _profiles
+
+
+def _ward(profiles, ids):
+    return linkage(_resample(profiles, ids), 'ward')
+
+
+def _columns(data, ids):
+    # average linkage of the resampled columns of features x samples data
+    data = data[:, ids]
+    return linkage(data.toarray() if issparse(data) else data, 'average')
+
+
+class TestClades(unittest.TestCase):
+
+    def test_linkage_clades(self):
+        lm = np.array([[0, 2, 1, 2], [1, 3, 2, 2], [4, 5, 3, 4]])
+        self.assertEqual(_linkage_clades(lm, 4), [0b101, 0b1010, 0b1111])
+
+    def test_tree_clades(self):
+        state = np.random.RandomState(0)
+        lm = linkage(state.normal(size=(10, 3)), 'ward')
+        features = ['F%d' % i for i in range(10)]
+        tree = TreeNode.from_linkage_matrix(lm, features)
+        nodes, clades = _tree_clades(tree, features)
+        self.assertEqual(len(nodes), 8)
+        self.assertEqual(sorted(clades), sorted(_linkage_clades(lm, 10)[:-1]))
+        # nodes with unknown tips are left out
+        nodes, clades = _tree_clades(tree, features[1:])
+        self.assertTrue(all(n.count(tips=True) < 10 for n in nodes))
+        self.assertTrue(all('F0' not in [t.name for t in n.tips()]
+                            for n in nodes))
+
+    def test_tree_clades_filtered(self):
+        # the node of all the features, under a root with other tips, is
+        # in every replicate
+        tree = TreeNode.read(['(((a,b)y2,c)y1,(d,e)y3)y0;'])
+        nodes, clades = _tree_clades(tree, 'abc')
+        self.assertEqual([n.name for n in nodes], ['y2'])
+        self.assertEqual(clades, [0b011])
+
+    def test_label_support(self):
+        tree = TreeNode.read(['((a,b)y1,(c,d)y2)y0;'])
+        nodes, _ = _tree_clades(tree, 'abcd')
+        _label_support(nodes, [0.95, 1.0])
+        tree = TreeNode.read([str(tree)])
+        tree.assign_supports()
+        self.assertEqual([(n.name, n.support) for n in tree.non_tips()],
+                         [('y1', 0.95), ('y2', 1)])
+
+
+class TestBootstrap(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.counts = state.poisson(state.lognormal(2, 1, size=(40, 12)))
+
+    def test_resample(self):
+        ids = np.random.RandomState(1).randint(0, 40, 40)
+        exp = _profiles(self.counts[ids], 0.5)
+        npt.assert_allclose(_resample(_profiles(self.counts, 0.5), ids), exp,
+                            atol=1e-12)
+        counts = self.counts * (self.counts > 5)
+        sparse = _SparseProfiles.from_counts(csr_matrix(counts), 0.5)
+        npt.assert_allclose(_resample(sparse, ids).toarray(),
+                            _profiles(counts[ids], 0.5), atol=1e-12)
+
+    def test_support(self):
+        profiles = _profiles(self.counts, 0.5)
+        clades = _linkage_clades(linkage(profiles, 'ward'), 12)[:-1]
+        exp = _bootstrap_support(clades, profiles, _ward, n_bootstraps=20)
+        self.assertEqual(exp.shape, (10,))
+        self.assertTrue(((exp >= 0) & (exp <= 1)).all())
+        npt.assert_array_equal(exp * 20, np.round(exp * 20))
+        res = _bootstrap_support(clades, profiles, _ward, n_bootstraps=20,
+                                 n_jobs=2)
+        npt.assert_array_equal(res, exp)
+        # the clade of all of the features is in every replicate
+        npt.assert_array_equal(
+            _bootstrap_support([2 ** 12 - 1], profiles, _ward,
+                               n_bootstraps=5), [1])
+
+    def test_support_csr(self):
+        counts = (self.counts * (self.counts > 5)).T
+        clades = _linkage_clades(linkage(counts, 'average'), 12)[:-1]
+        exp = _bootstrap_support(clades, counts, _columns, n_bootstraps=20)
+        for n_jobs in (1, 2):
+            res = _bootstrap_support(clades, csr_matrix(counts), _columns,
+                                     n_bootstraps=20, n_jobs=n_jobs)
+            npt.assert_array_equal(res, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
+from scipy.cluster.hierarchy import linkage
+
+from q2_gneiss.cluster._checkpoint import _Checkpoint, _fingerprint
+from q2_gneiss.cluster._distance import (_profiles, _profile_variation,
+                                         _variation_rows)
+
+
+class Preempted(Exception):
+    pass
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.counts = state.poisson(state.lognormal(2, 1.5, size=(30, 25)))
+        self.profiles = _profiles(self.counts, 0.5)
+        self.exp = linkage(_profile_variation(self.profiles), 'ward')
+        self.fingerprint = _fingerprint(self.counts, 0.5)
+
+    def run_checkpoint(self, tmp):
+        checkpoint = _Checkpoint(tmp, self.fingerprint, 25)
+        checkpoint.variation(self.profiles)
+        lm = checkpoint.linkage()
+        checkpoint.close()
+        return lm
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            npt.assert_array_equal(self.run_checkpoint(tmp), self.exp)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_resume_variation(self):
+        calls = []
+
+        def preempt(*args):
+            if len(calls) == 10:
+                raise Preempted()
+            calls.append(args[2])
+            _variation_rows(*args)
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch('q2_gneiss.cluster._distance._TILE_ROWS', 1), \
+                mock.patch('q2_gneiss.cluster._checkpoint.'
+                           '_CHECKPOINT_SECONDS', 0):
+            # tiles of one row round differently from a single tile
+            exp = linkage(_profile_variation(self.profiles), 'ward')
+            with mock.patch('q2_gneiss.cluster._distance._variation_rows',
+                            preempt):
+                with self.assertRaises(Preempted):
+                    self.run_checkpoint(tmp)
+            with mock.patch('q2_gneiss.cluster._distance._variation_rows',
+                            side_effect=_variation_rows) as rows:
+                npt.assert_array_equal(self.run_checkpoint(tmp), exp)
+            # the tiles written before the preemption are not recomputed
+            self.assertEqual(rows.call_args_list[0][0][2], slice(10, 11))
+
+    def test_resume_linkage(self):
+        # a checkpoint after the 3rd merge, and a preemption after the 7th:
+        # the rerun undoes the 4th to 7th merges in the matrix
+        after = _Checkpoint.after
+
+        def preempt(self, k, *args):
+            with mock.patch.object(_Checkpoint, '_due', return_value=k == 3):
+                after(self, k, *args)
+            if k == 7:
+                raise Preempted()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.object(_Checkpoint, 'after', preempt):
+                with self.assertRaises(Preempted):
+                    self.run_checkpoint(tmp)
+            checkpoint = _Checkpoint(tmp, self.fingerprint, 25)
+            self.assertEqual(len(checkpoint.state['merges']), 3)
+            self.assertEqual(len(checkpoint._undo_records()), 4)
+            lm = checkpoint.linkage()
+            checkpoint.close()
+        npt.assert_array_equal(lm, self.exp)
+
+    def test_truncated_undo(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = _Checkpoint(tmp, self.fingerprint, 25)
+            checkpoint.variation(self.profiles)
+            checkpoint.resume()
+            checkpoint.before(0, np.array([1, 2]), np.array([0.5, 0.25]))
+            checkpoint.before(1, np.array([3]), np.array([0.125]))
+            checkpoint._undo.truncate(checkpoint._undo.tell() - 4)
+            checkpoint._undo.flush()
+            records = checkpoint._undo_records()
+            self.assertEqual(len(records), 1)
+            npt.assert_array_equal(records[0][1], [1, 2])
+            npt.assert_array_equal(records[0][2], [0.5, 0.25])
+            checkpoint.close()
+
+    def test_other_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = _Checkpoint(tmp, self.fingerprint, 25)
+            checkpoint.variation(self.profiles)
+            other = _fingerprint(self.counts, 0.1)
+            self.assertNotEqual(other, self.fingerprint)
+            with self.assertRaisesRegex(ValueError, 'other inputs'):
+                _Checkpoint(tmp, other, 25)
+            checkpoint.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
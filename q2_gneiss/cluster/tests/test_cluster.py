@@ -5,6 +5,8 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import os
+import tempfile
 import unittest
 import qiime2
 import pandas as pd
@@ -40,6 +42,159 @@ class TestClusteringPlugin(unittest.TestCase):
         exp_tree = TreeNode.read([exp_str])
         self.assert_tree_almost_equals(exp_tree, res_clust)
 
+    def test_proportional_artifact_float32(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        exp = correlation_clustering(in_table, pseudocount=0.1)
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     precision='float32')
+        exp_clust = exp.clustering._view(TreeNode)
+        res_clust = res.clustering._view(TreeNode)
+        for n, m in zip(exp_clust.postorder(include_self=True),
+                        res_clust.postorder(include_self=True)):
+            self.assertEqual(n.name, m.name)
+            if n.length is not None:
+                npt.assert_allclose(m.length, n.length, atol=1e-5)
+
+    def test_proportional_artifact_scratch(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        exp = correlation_clustering(in_table, pseudocount=0.1)
+        with tempfile.TemporaryDirectory() as scratch:
+            res = correlation_clustering(in_table, pseudocount=0.1,
+                                         scratch_dir=scratch)
+            self.assertEqual(os.listdir(scratch), [])
+        exp_clust = exp.clustering._view(TreeNode)
+        res_clust = res.clustering._view(TreeNode)
+        for n, m in zip(exp_clust.postorder(include_self=True),
+                        res_clust.postorder(include_self=True)):
+            self.assertEqual(n.name, m.name)
+            if n.length is not None:
+                npt.assert_allclose(m.length, n.length, atol=1e-6)
+
+    def test_proportional_artifact_checkpoint(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        exp = correlation_clustering(in_table, pseudocount=0.1)
+        with tempfile.TemporaryDirectory() as checkpoint:
+            res = correlation_clustering(in_table, pseudocount=0.1,
+                                         checkpoint_dir=checkpoint)
+            self.assertEqual(os.listdir(checkpoint), [])
+        self.assertEqual(str(exp.clustering._view(TreeNode)),
+                         str(res.clustering._view(TreeNode)))
+
+    def test_proportional_artifact_vector(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     engine='vector')
+        res_clust = res.clustering._view(TreeNode)
+        exp_str = ('(((F1:0.00722086039263,F2:0.00722086039263)'
+                   'y3:0.34814400911,(F4:0.194020033249,F5:0.194020033249)'
+                   'y4:0.161344836254)y1:0.436846899387,'
+                   '(F3:0.365268215007,F6:0.365268215007)'
+                   'y2:0.426943553883)y0;\n')
+        exp_tree = TreeNode.read([exp_str])
+        self.assert_tree_almost_equals(exp_tree, res_clust)
+
+    def test_proportional_artifact_knn(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     engine='knn', n_neighbors=2)
+        res_clust = res.clustering._view(TreeNode)
+        self.assertEqual(sorted(n.name for n in res_clust.tips()),
+                         ['F1', 'F2', 'F3', 'F4', 'F5', 'F6'])
+        for n in res_clust.non_tips(include_self=True):
+            self.assertEqual(len(n.children), 2)
+
+    def test_proportional_artifact_negative_seed(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        with self.assertRaises(TypeError):
+            correlation_clustering(in_table, engine='knn', random_seed=-1)
+
+    def test_proportional_artifact_filter(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     min_prevalence=1.0)
+        res_clust = res.clustering._view(TreeNode)
+        exp_str = ('((F4:0.228723591874,(F5:0.074748541601,'
+                   '(F1:0.00010428164962,F2:0.00010428164962)'
+                   'y4:0.0746442599513)y3:0.153975050273)y1,'
+                   '(F3,F6)y2)y0;\n')
+        exp_tree = TreeNode.read([exp_str])
+        self.assert_tree_almost_equals(exp_tree, res_clust)
+
+        res = correlation_clustering(in_table, pseudocount=0.1, top_k_var=5)
+        res_clust = res.clustering._view(TreeNode)
+        self.assertEqual(res_clust.children[1].name, 'F5')
+        self.assertEqual(sorted(n.name for n in res_clust.tips()),
+                         ['F1', 'F2', 'F3', 'F4', 'F5', 'F6'])
+
+    def test_divisive_artifact(self):
+        from qiime2.plugins.gneiss.methods import (divisive_clustering,
+                                                   ilr_hierarchical)
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        res = divisive_clustering(in_table, pseudocount=0.1)
+        res_clust = res.clustering._view(TreeNode)
+        exp_str = '(((F1,F2)y3,(F4,F5)y4)y1,(F3,F6)y2)y0;\n'
+        self.assertEqual(exp_str, str(res_clust))
+        balances = ilr_hierarchical(in_table, res.clustering).balances
+        self.assertEqual(sorted(balances.view(pd.DataFrame).columns),
+                         ['y0', 'y1', 'y2', 'y3', 'y4'])
+
+    def test_proportional_artifact_bootstrap(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        exp = correlation_clustering(in_table, pseudocount=0.1)
+        exp_clust = exp.clustering._view(TreeNode)
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     n_bootstraps=20)
+        res_clust = res.clustering._view(TreeNode)
+        res_clust.assign_supports()
+        self.assert_tree_almost_equals(exp_clust, res_clust)
+        for n in res_clust.non_tips():
+            self.assertTrue(0 <= n.support <= 1)
+        self.assertIsNone(res_clust.support)
+
+    def test_proportional_artifact_filter_bootstrap(self):
+        from qiime2.plugins.gneiss.methods import correlation_clustering
+        table_f = get_data_path("feature-table.qza")
+        in_table = qiime2.Artifact.load(table_f)
+
+        res = correlation_clustering(in_table, pseudocount=0.1,
+                                     min_prevalence=1.0, n_bootstraps=20)
+        res_clust = res.clustering._view(TreeNode)
+        res_clust.assign_supports()
+        supports = {n.name: n.support for n in res_clust.non_tips(
+            include_self=True)}
+        # neither the root, the clade of the clustered features nor the
+        # clade of the filtered features has a support
+        for name in ['y0', 'y1', 'y2']:
+            self.assertIsNone(supports[name])
+        for name in ['y3', 'y4']:
+            self.assertTrue(0 <= supports[name] <= 1)
+
     def test_gradient_artifact(self):
         from qiime2.plugins.gneiss.methods import gradient_clustering
         table_f = get_data_path("test_gradient.biom.qza")
@@ -52,6 +207,20 @@ class TestClusteringPlugin(unittest.TestCase):
         exp_str = '((o1:0.5,o2:0.5)y1:0.5,(o3:0.5,o4:0.5)y2:0.5)y0;\n'
         self.assertEqual(exp_str, str(res_clust))
 
+    def test_gradient_artifact_bootstrap(self):
+        from qiime2.plugins.gneiss.methods import gradient_clustering
+        table_f = get_data_path("test_gradient.biom.qza")
+        metadata_f = get_data_path("test_metadata.txt")
+        in_table = qiime2.Artifact.load(table_f)
+        in_metadata = qiime2.Metadata.load(metadata_f)
+
+        res = gradient_clustering(in_table, in_metadata.get_column('x'),
+                                  n_bootstraps=20)
+        res_clust = res.clustering._view(TreeNode)
+        exp_str = ("((o1:0.5,o2:0.5)'0.75:y1':0.5,"
+                   "(o3:0.5,o4:0.5)'0.75:y2':0.5)y0;\n")
+        self.assertEqual(exp_str, str(res_clust))
+
     def test_gradient_match(self):
         # there are extra rows in match that need to be filtered out
         from qiime2.plugins.gneiss.methods import gradient_clustering
@@ -101,6 +270,33 @@ class TestClusteringPlugin(unittest.TestCase):
         # Checkpoint assertion
         self.assertTrue(True)
 
+    def test_multi_gradient_artifact(self):
+        from qiime2.plugins.gneiss.methods import (gradient_clustering,
+                                                   multi_gradient_clustering)
+        table_f = get_data_path("weighted.biom.qza")
+        metadata_f = get_data_path("test_metadata.txt")
+        in_table = qiime2.Artifact.load(table_f)
+        in_metadata = qiime2.Metadata.load(metadata_f)
+
+        res = multi_gradient_clustering(in_table, in_metadata,
+                                        weighted=False)
+        self.assertEqual(list(res.clusterings.keys()), ['x'])
+        exp = gradient_clustering(in_table, in_metadata.get_column('x'),
+                                  weighted=False)
+        self.assertEqual(str(res.clusterings['x']._view(TreeNode)),
+                         str(exp.clustering._view(TreeNode)))
+
+    def test_multi_gradient_no_numeric(self):
+        from qiime2.plugins.gneiss.methods import multi_gradient_clustering
+        table_f = get_data_path("weighted.biom.qza")
+        metadata_f = get_data_path("test_metadata.txt")
+        in_table = qiime2.Artifact.load(table_f)
+        in_metadata = qiime2.Metadata.load(metadata_f)
+        in_metadata = in_metadata.filter_columns(column_type='categorical')
+
+        with self.assertRaisesRegex(ValueError, 'no numeric column'):
+            multi_gradient_clustering(in_table, in_metadata)
+
     def test_assign_ids(self):
         from qiime2.plugins.gneiss.methods import assign_ids
         tree_f = get_data_path("tree.qza")
@@ -0,0 +1,160 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from gneiss.composition import variation_matrix
+from scipy.sparse import csr_matrix, issparse
+from scipy.spatial.distance import pdist
+
+from q2_gneiss._util import add_pseudocount
+from q2_gneiss.cluster._distance import (_SparseProfiles, _profiles,
+                                         _profile_variation, _sketch,
+                                         _sketch_dim)
+
+
+def _variation(mat, pseudocount=0.5, dtype=np.float64, out=None, n_jobs=1,
+               distortion=None, seed=0):
+    # variation matrix of a table, from the profiles that
+    # correlation_clustering builds
+    if issparse(mat):
+        profiles = _SparseProfiles.from_counts(mat, pseudocount,
+                                               dtype=dtype)
+        if distortion is not None:
+            profiles = _sketch(profiles, distortion, seed)
+    else:
+        profiles = _profiles(mat, pseudocount, dtype=dtype,
+                             distortion=distortion, seed=seed)
+    return _profile_variation(profiles, out=out, n_jobs=n_jobs)
+
+
+class TestVariation(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.counts = state.poisson(state.lognormal(2, 1.5, size=(60, 40)))
+
+    def test_variation(self):
+        table = add_pseudocount(pd.DataFrame(self.counts), 0.5)
+        exp = variation_matrix(table).condensed_form()
+        npt.assert_allclose(_variation(self.counts, 0.5), exp, atol=1e-12)
+
+    def test_variation_tiles(self):
+        exp = _variation(self.counts, 0.5)
+        # tiles of 1 and 3 rows, written into a given buffer
+        for entries in [40, 120]:
+            out = np.zeros(len(exp))
+            with mock.patch('q2_gneiss.cluster._distance._BLOCK_ENTRIES',
+                            entries):
+                res = _variation(self.counts, 0.5, out=out)
+            self.assertIs(res, out)
+            npt.assert_allclose(res, exp, atol=1e-12)
+
+    def test_variation_processes(self):
+        with mock.patch('q2_gneiss.cluster._distance._TILE_ROWS', 6):
+            exp = _variation(self.counts, 0.5)
+            res = _variation(self.counts, 0.5, n_jobs=3)
+            npt.assert_array_equal(res, exp)
+            with tempfile.TemporaryDirectory() as tmp:
+                out = np.memmap(os.path.join(tmp, 'dist'), dtype=np.float32,
+                                mode='w+', shape=exp.shape)
+                _variation(self.counts, 0.5, out=out, n_jobs=2)
+                npt.assert_allclose(out, exp, rtol=1e-6)
+                del out
+        with self.assertRaisesRegex(ValueError, 'n_jobs'):
+            _variation(self.counts, 0.5, n_jobs=0)
+
+    def test_variation_sparse(self):
+        counts = self.counts * (self.counts > 10)
+        exp = _variation(counts, 0.5)
+        res = _variation(csr_matrix(counts), 0.5)
+        npt.assert_allclose(res, exp, atol=1e-12)
+        with mock.patch('q2_gneiss.cluster._distance._TILE_ROWS', 6):
+            res = _variation(csr_matrix(counts), 0.5, n_jobs=2)
+        npt.assert_allclose(res, exp, atol=1e-12)
+        res = _variation(csr_matrix(counts), 0.5, dtype=np.float32)
+        self.assertEqual(res.dtype, np.float32)
+        npt.assert_allclose(res, exp, rtol=1e-5)
+
+    def test_profiles(self):
+        profiles = _profiles(self.counts, 0.5)
+        self.assertEqual(profiles.shape, (40, 60))
+        self.assertTrue(profiles.flags.c_contiguous)
+        npt.assert_allclose(pdist(profiles, 'sqeuclidean'),
+                            _variation(self.counts, 0.5), atol=1e-12)
+
+    def test_variation_float32(self):
+        # float32 distances are within the bound documented for `precision`:
+        # n * eps times the largest feature variance, with n the number of
+        # samples
+        exp = _variation(self.counts, 0.5)
+        res = _variation(self.counts, 0.5, dtype=np.float32)
+        self.assertEqual(res.dtype, np.float32)
+        logs = np.log(add_pseudocount(pd.DataFrame(self.counts), 0.5))
+        bound = 60 * np.finfo(np.float32).eps * logs.var(ddof=0).max()
+        npt.assert_allclose(res, exp, rtol=0, atol=bound)
+        self.assertTrue((res >= 0).all())
+
+
+class TestSketch(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.counts = state.poisson(
+            state.lognormal(2, 1.5, size=(3000, 30)))
+
+    def test_sketch_dim(self):
+        self.assertEqual(_sketch_dim(30, 0.5), 164)
+        self.assertLess(_sketch_dim(10000, 0.5), 500)
+        with self.assertRaisesRegex(ValueError, 'distortion'):
+            _sketch_dim(30, 1.5)
+
+    def test_sketch(self):
+        exp = _variation(self.counts, 0.5)
+        res = _variation(self.counts, 0.5, distortion=0.5, seed=1)
+        self.assertEqual(_profiles(self.counts, 0.5, distortion=0.5).shape,
+                         (30, 164))
+        ratio = res / exp
+        self.assertTrue((ratio > 0.5).all() and (ratio < 1.5).all())
+        npt.assert_array_equal(
+            _variation(self.counts, 0.5, distortion=0.5, seed=1), res)
+        self.assertFalse(np.array_equal(
+            _variation(self.counts, 0.5, distortion=0.5, seed=2), res))
+
+    def test_sketch_blocks(self):
+        profiles = _profiles(self.counts, 0.5)
+        exp = _sketch(profiles, 0.5)
+        with mock.patch('q2_gneiss.cluster._distance._BLOCK_ENTRIES', 1000):
+            npt.assert_allclose(_sketch(profiles, 0.5), exp, atol=1e-12)
+
+    def test_sketch_sparse(self):
+        counts = self.counts * (self.counts > 10)
+        exp = _profiles(counts, 0.5, distortion=0.5)
+        npt.assert_allclose(_profiles(csr_matrix(counts), 0.5,
+                                      distortion=0.5), exp, atol=1e-12)
+        npt.assert_allclose(_variation(csr_matrix(counts), 0.5,
+                                       distortion=0.5),
+                            pdist(exp, 'sqeuclidean'), atol=1e-12)
+
+    def test_sketch_few_samples(self):
+        # no sketch is smaller than the samples themselves
+        counts = self.counts[:100]
+        npt.assert_array_equal(_profiles(counts, 0.5, distortion=0.5),
+                               _profiles(counts, 0.5))
+        npt.assert_allclose(_profiles(csr_matrix(counts), 0.5,
+                                      distortion=0.5),
+                            _profiles(counts, 0.5), atol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
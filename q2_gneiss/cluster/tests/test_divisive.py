@@ -0,0 +1,85 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy.sparse import csr_matrix
+
+from q2_gneiss.cluster._distance import _SparseProfiles, _profiles
+from q2_gneiss.cluster._divisive import _divisive_tree, _principal_split
+
+
+class TestPrincipalSplit(unittest.TestCase):
+
+    def setUp(self):
+        # two groups of features that covary in opposite directions
+        state = np.random.RandomState(0)
+        trend = np.linspace(-2, 2, 30)
+        logmu = np.vstack([3 + trend + state.normal(0, 0.1, size=(10, 30)),
+                           3 - trend + state.normal(0, 0.1, size=(10, 30))])
+        self.counts = state.poisson(np.exp(logmu)).T
+
+    def test_split(self):
+        positive = _principal_split(_profiles(self.counts, 0.5))
+        self.assertEqual(len(set(positive[:10])), 1)
+        self.assertEqual(len(set(positive[10:])), 1)
+        self.assertNotEqual(positive[0], positive[10])
+
+    def test_split_sparse(self):
+        counts = self.counts * (self.counts > 5)
+        exp = _principal_split(_profiles(counts, 0.5), seed=3)
+        res = _principal_split(
+            _SparseProfiles.from_counts(csr_matrix(counts), 0.5), seed=3)
+        npt.assert_array_equal(res, exp)
+
+    def test_split_sign(self):
+        profiles = _profiles(self.counts, 0.5)
+        exp = _principal_split(profiles)
+        npt.assert_array_equal(_principal_split(profiles[::-1]), exp[::-1])
+        # power iteration from different starts
+        profiles = np.vstack([profiles] * 4)
+        exp = _principal_split(profiles)
+        for seed in range(1, 4):
+            npt.assert_array_equal(_principal_split(profiles, seed=seed), exp)
+
+    def test_split_identical(self):
+        profiles = np.zeros((5, 4))
+        npt.assert_array_equal(_principal_split(profiles),
+                               [False, False, True, True, True])
+
+
+class TestDivisiveTree(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.counts = state.poisson(state.lognormal(2, 1.5, size=(30, 50)))
+        self.features = ['F%d' % i for i in range(50)]
+
+    def test_tree(self):
+        t = _divisive_tree(_profiles(self.counts, 0.5), self.features)
+        self.assertEqual(sorted(n.name for n in t.tips()),
+                         sorted(self.features))
+        for n in t.non_tips(include_self=True):
+            self.assertEqual(len(n.children), 2)
+
+    def test_tree_deterministic(self):
+        profiles = _profiles(self.counts, 0.5)
+        exp = str(_divisive_tree(profiles, self.features, seed=1))
+        self.assertEqual(
+            str(_divisive_tree(profiles, self.features, seed=1, n_jobs=3)),
+            exp)
+        sparse = _SparseProfiles.from_counts(
+            csr_matrix(self.counts * (self.counts > 5)), 0.5)
+        dense = _profiles(self.counts * (self.counts > 5), 0.5)
+        self.assertEqual(str(_divisive_tree(sparse, self.features)),
+                         str(_divisive_tree(dense, self.features)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy.sparse import csr_matrix
+
+from q2_gneiss.cluster._filter import _feature_filter
+
+
+class TestFeatureFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.counts = np.array([[0, 1, 5, 0, 2],
+                                [0, 3, 1, 1, 2],
+                                [1, 9, 0, 0, 2],
+                                [0, 1, 7, 0, 2]])
+
+    def test_no_filter(self):
+        npt.assert_array_equal(_feature_filter(self.counts), np.arange(5))
+
+    def test_prevalence(self):
+        npt.assert_array_equal(
+            _feature_filter(self.counts, min_prevalence=0.5), [1, 2, 4])
+        npt.assert_array_equal(
+            _feature_filter(self.counts, min_prevalence=1), [1, 4])
+
+    def test_total_count(self):
+        npt.assert_array_equal(
+            _feature_filter(self.counts, min_total_count=8), [1, 2, 4])
+
+    def test_top_k_var(self):
+        res = _feature_filter(self.counts, top_k_var=2)
+        npt.assert_array_equal(res, [1, 2])
+        res = _feature_filter(self.counts, min_total_count=2, top_k_var=2)
+        npt.assert_array_equal(res, [1, 2])
+        res = _feature_filter(self.counts, min_prevalence=1, top_k_var=1)
+        npt.assert_array_equal(res, [1])
+
+    def test_sparse(self):
+        for kwargs in [dict(min_prevalence=0.5), dict(min_total_count=8),
+                       dict(top_k_var=3)]:
+            npt.assert_array_equal(
+                _feature_filter(csr_matrix(self.counts), **kwargs),
+                _feature_filter(self.counts, **kwargs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from scipy.sparse import csr_matrix
+from gneiss.sort import mean_niche_estimator
+
+from q2_gneiss.cluster._gradient import _align, _mean_niche
+
+
+class TestAlign(unittest.TestCase):
+
+    def test_align(self):
+        gradient = pd.Series([1.0, 2.0, 3.0], index=['s1', 's2', 's3'])
+        ids, g = _align(['s3', 'x', 's1'], gradient)
+        npt.assert_array_equal(ids, [2, 0])
+        npt.assert_array_equal(g, [1.0, 3.0])
+
+    def test_align_frame(self):
+        gradients = pd.DataFrame({'a': [1.0, 2.0], 'b': [3.0, 4.0]},
+                                 index=['s1', 's2'])
+        ids, g = _align(['s2', 's1'], gradients)
+        npt.assert_array_equal(ids, [1, 0])
+        npt.assert_array_equal(g, [[1.0, 3.0], [2.0, 4.0]])
+
+    def test_no_samples(self):
+        gradient = pd.Series([1.0], index=['s1'])
+        with self.assertRaisesRegex(ValueError, 'No more samples'):
+            _align(['x', 'y'], gradient)
+
+    def test_duplicates(self):
+        gradient = pd.Series([1.0, 2.0], index=['s1', 's1'])
+        with self.assertRaisesRegex(ValueError, 'duplicate'):
+            _align(['s1'], gradient)
+
+
+class TestMeanNiche(unittest.TestCase):
+
+    def setUp(self):
+        self.counts = np.array([[0, 1, 5, 0],
+                                [2, 3, 1, 0],
+                                [1, 9, 0, 0],
+                                [0, 1, 7, 0]], dtype=float)
+        self.gradient = np.array([0.5, 1.0, 2.0, 4.0])
+
+    def test_dense(self):
+        exp = mean_niche_estimator(pd.DataFrame(self.counts[:, :3]),
+                                   pd.Series(self.gradient))
+        res = _mean_niche(self.counts, self.gradient)
+        npt.assert_allclose(res[:3], exp.values)
+        self.assertTrue(np.isnan(res[3]))
+
+    def test_sparse(self):
+        npt.assert_allclose(_mean_niche(csr_matrix(self.counts),
+                                        self.gradient),
+                            _mean_niche(self.counts, self.gradient))
+
+    def test_presence(self):
+        exp = mean_niche_estimator(pd.DataFrame(self.counts[:, :3] > 0),
+                                   pd.Series(self.gradient))
+        res = _mean_niche(self.counts, self.gradient, weighted=False)
+        npt.assert_allclose(res[:3], exp.values)
+        self.assertTrue(np.isnan(res[3]))
+
+    @mock.patch('q2_gneiss.cluster._gradient._BLOCK_ENTRIES', 4)
+    def test_presence_sparse(self):
+        counts = csr_matrix(self.counts)
+        # explicit zeros are absences
+        counts.data[0] = 0
+        exp = _mean_niche(counts.toarray(), self.gradient, weighted=False)
+        npt.assert_allclose(_mean_niche(counts, self.gradient,
+                                        weighted=False), exp)
+
+    def test_gradients(self):
+        gradients = np.column_stack([self.gradient, self.gradient ** 2])
+        for weighted in (True, False):
+            for counts in (self.counts, csr_matrix(self.counts)):
+                res = _mean_niche(counts, gradients, weighted)
+                self.assertEqual(res.shape, (4, 2))
+                for i in range(2):
+                    npt.assert_allclose(
+                        res[:, i], _mean_niche(counts, gradients[:, i],
+                                               weighted))
+
+
+if __name__ == '__main__':
+    unittest.main()
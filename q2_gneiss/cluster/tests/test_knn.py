@@ -0,0 +1,71 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy.cluster.hierarchy import is_valid_linkage, linkage
+from scipy.spatial.distance import cdist
+
+from q2_gneiss.cluster._knn import _knn_ward, _rp_knn
+
+
+class TestRPKnn(unittest.TestCase):
+
+    def setUp(self):
+        state = np.random.RandomState(0)
+        self.X = state.randn(200, 5)
+        dist = cdist(self.X, self.X, 'sqeuclidean')
+        np.fill_diagonal(dist, np.inf)
+        self.exact = np.argsort(dist, axis=1)[:, :5]
+        self.dist = np.sort(dist, axis=1)[:, :5]
+
+    def test_rp_knn_single_leaf(self):
+        ids, dist = _rp_knn(self.X, 5, n_trees=1, leaf_size=200)
+        npt.assert_array_equal(ids, self.exact)
+        npt.assert_allclose(dist, self.dist)
+
+    def test_rp_knn_recall(self):
+        ids, _ = _rp_knn(self.X, 5, n_trees=10, leaf_size=20)
+        recall = np.mean([len(set(a) & set(b)) / 5
+                          for a, b in zip(ids, self.exact)])
+        self.assertGreater(recall, 0.9)
+        # the seed fixes the projections
+        npt.assert_array_equal(_rp_knn(self.X, 5, leaf_size=20, seed=1)[0],
+                               _rp_knn(self.X, 5, leaf_size=20, seed=1)[0])
+
+
+class TestKnnWard(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.random.RandomState(1).randn(40, 4)
+
+    def test_knn_ward_complete_graph(self):
+        neighbors = np.array([[j for j in range(40) if j != i]
+                              for i in range(40)])
+        npt.assert_allclose(_knn_ward(self.X, neighbors, n_exact=1),
+                            linkage(self.X, 'ward'), atol=1e-12)
+
+    def test_knn_ward_no_graph(self):
+        neighbors = np.full((40, 1), -1)
+        npt.assert_allclose(_knn_ward(self.X, neighbors),
+                            linkage(self.X, 'ward'), atol=1e-12)
+
+    def test_knn_ward_chains(self):
+        # two disconnected chains, merged along their edges only
+        neighbors = np.array([[i + 1 if i not in (19, 39) else -1]
+                              for i in range(40)])
+        Z = _knn_ward(self.X, neighbors, n_exact=2)
+        self.assertTrue(is_valid_linkage(Z))
+        self.assertTrue((np.diff(Z[:, 2]) >= 0).all())
+        root = Z[-1, :2].astype(int) - 40
+        npt.assert_array_equal(Z[root, 3], [20, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
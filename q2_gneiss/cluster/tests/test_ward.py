@@ -0,0 +1,70 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+
+from q2_gneiss.cluster._ward import _matrix_ward, _vector_ward
+
+
+class TestVectorWard(unittest.TestCase):
+
+    def test_vector_ward(self):
+        for seed in range(3):
+            X = np.random.RandomState(seed).randn(50, 6)
+            npt.assert_allclose(_vector_ward(X), linkage(X, 'ward'),
+                                atol=1e-12)
+
+    def test_vector_ward_blocks(self):
+        # neighbor queries over blocks of 2 observations
+        X = np.random.RandomState(3).randn(30, 4)
+        with mock.patch('q2_gneiss.cluster._ward._BLOCK_ENTRIES', 8):
+            npt.assert_allclose(_vector_ward(X), linkage(X, 'ward'),
+                                atol=1e-12)
+
+    def test_vector_ward_two(self):
+        Z = _vector_ward(np.array([[0., 0.], [3., 4.]]))
+        npt.assert_allclose(Z, [[0, 1, 5, 2]])
+
+
+class TestMatrixWard(unittest.TestCase):
+
+    def test_matrix_ward(self):
+        for seed in range(3):
+            X = np.random.RandomState(seed).randn(60, 5)
+            dist = pdist(X, 'sqeuclidean')
+            exp = linkage(dist, 'ward')
+            npt.assert_array_equal(_matrix_ward(dist.copy(), 60), exp)
+
+    def test_matrix_ward_ties(self):
+        dist = pdist(np.arange(6.)[:, None])
+        npt.assert_array_equal(_matrix_ward(dist.copy(), 6),
+                               linkage(dist, 'ward'))
+
+    def test_matrix_ward_memmap(self):
+        X = np.random.RandomState(4).randn(40, 5)
+        dist = pdist(X, 'sqeuclidean').astype(np.float32)
+        exp = linkage(dist, 'ward')
+        with tempfile.TemporaryDirectory() as tmp:
+            mm = np.memmap(os.path.join(tmp, 'dist'), dtype=np.float32,
+                           mode='w+', shape=dist.shape)
+            mm[:] = dist
+            res = _matrix_ward(mm, 40)
+            del mm
+        npt.assert_array_equal(res[:, [0, 1, 3]], exp[:, [0, 1, 3]])
+        npt.assert_allclose(res[:, 2], exp[:, 2], rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
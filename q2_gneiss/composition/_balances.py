@@ -0,0 +1,146 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import numpy as np
+from scipy.sparse import issparse
+
+from q2_gneiss._util import _BLOCK_ENTRIES, _parallel_map, _row_blocks
+
+
+# Trees with at most this many tips multiply the explicit (dense) basis.
+_DENSE_BASIS_TIPS = 256
+
+
+def _basis(start, split, stop, n_tips, dtype=np.float64):
+    """ Dense ilr basis (tips x nodes) for the given tip ranges. """
+    r, s = stop - split, split - start
+    basis = np.zeros((n_tips, len(start)), dtype=dtype)
+    for i in range(len(start)):
+        basis[split[i]:stop[i], i] = np.sqrt(s[i] / (r[i] * (r[i] + s[i])))
+        basis[start[i]:split[i], i] = -np.sqrt(r[i] / (s[i] * (r[i] + s[i])))
+    return basis
+
+
+def _basis_balances(mat, start, split, stop):
+    """ Balances through an explicit product with the dense basis. """
+    basis = _basis(start, split, stop, mat.shape[1], dtype=mat.dtype)
+    if issparse(mat):
+        return np.asarray(mat @ basis)
+    # unlike a BLAS product, einsum reduces every row on its own, so the
+    # result does not depend on how the samples are split into blocks
+    return np.einsum('ij,jk->ik', mat, basis)
+
+
+def _prefix_balances(mat, start, split, stop):
+    """ Balances from prefix sums over the (postorder) tips.
+
+    Every balance only needs the mean log abundance of the tips under each
+    child, which is a difference of two prefix sums, so no basis is formed
+    and the cost is O(samples x tips).  Sparse input is densified one block
+    of rows at a time, so its cost does not shrink with the number of
+    nonzero entries: the balances of a block are dense samples x nodes
+    anyway, and a prefix sum over the nonzeros of a row still has to be
+    evaluated at every tip boundary.  The prefix sums of a block are always
+    accumulated in float64, since the differences of long sums cancel;
+    only the balances take the type of ``mat``.
+    """
+    n_samples, n_tips = mat.shape
+    r, s = stop - split, split - start
+    scale = np.sqrt(r * s / (r + s))
+    balances = np.empty((n_samples, len(start)), dtype=mat.dtype)
+    step = max(1, _BLOCK_ENTRIES // (n_tips + 1))
+    for lo in range(0, n_samples, step):
+        block = mat[lo:lo + step]
+        if issparse(block):
+            block = block.toarray()
+        sums = np.zeros((block.shape[0], n_tips + 1))
+        np.cumsum(block, axis=1, out=sums[:, 1:])
+        num = sums[:, stop] - sums[:, split]
+        num /= r
+        den = sums[:, split] - sums[:, start]
+        den /= s
+        num -= den
+        num *= scale
+        balances[lo:lo + step] = num
+    return balances
+
+
+def _balances(mat, start, split, stop):
+    """ Balances of a samples x tips matrix of log abundances.
+
+    Up to ``_DENSE_BASIS_TIPS`` tips, the matrix is multiplied with the
+    explicit basis, which keeps a sparse matrix sparse.  Larger trees use
+    the prefix sums of ``_prefix_balances``, which densify a sparse matrix
+    one block of rows at a time.
+
+    Parameters
+    ----------
+    mat : np.ndarray or scipy.sparse.spmatrix
+        Log abundances, with columns ordered like the tips in postorder.
+    start, split, stop : np.ndarray of int
+        Tip ranges of the internal nodes (see ``TipIndex``).
+
+    Returns
+    -------
+    np.ndarray
+        Samples x nodes matrix of balances, of the same type as ``mat``.
+    """
+    if mat.shape[1] <= _DENSE_BASIS_TIPS:
+        return _basis_balances(mat, start, split, stop)
+    return _prefix_balances(mat, start, split, stop)
+
+
+def _balance_variance(mat, start, split, stop, transform=None, n_jobs=1):
+    """ Sample variance (ddof=1) of every balance, without holding them all.
+
+    The balances are computed one block of rows at a time and the per-block
+    counts, means and sums of squared deviations are merged with the
+    pairwise update of Chan et al., so memory is bounded by the block size
+    rather than by the number of samples.  The moments are accumulated in
+    float64 whatever the type of ``mat``.  The blocks do not depend on
+    ``n_jobs`` and are merged in order, so neither does the result.
+
+    Parameters
+    ----------
+    mat : np.ndarray or scipy.sparse.spmatrix
+        Log abundances, with columns ordered like the tips in postorder, or
+        any matrix that ``transform`` maps to them.
+    start, split, stop : np.ndarray of int
+        Tip ranges of the internal nodes (see ``TipIndex``).
+    transform : callable, optional
+        Applied to every block of rows of ``mat`` before its balances are
+        computed (e.g. the log transform).
+    n_jobs : int
+        Number of threads over which the blocks are spread.
+
+    Returns
+    -------
+    np.ndarray
+        Variance of each balance.
+    """
+    def _moments(rows):
+        block = mat[rows]
+        if transform is not None:
+            block = transform(block)
+        block = _balances(block, start, split, stop)
+        block = block.astype(np.float64, copy=False)
+        block_mean = block.mean(axis=0)
+        block -= block_mean
+        return block.shape[0], block_mean, np.einsum('ij,ij->j', block, block)
+
+    count = 0
+    mean = np.zeros(len(start))
+    m2 = np.zeros(len(start))
+    step = max(1, _BLOCK_ENTRIES // (len(start) + 1))
+    blocks = _row_blocks(mat.shape[0], step)
+    for n, block_mean, block_m2 in _parallel_map(_moments, blocks, n_jobs):
+        delta = block_mean - mean
+        total = count + n
+        mean += delta * (n / total)
+        m2 += block_m2 + delta ** 2 * (count * n / total)
+        count = total
+    return m2 / (count - 1)
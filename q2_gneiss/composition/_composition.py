@@ -17,15 +17,29 @@ from q2_gneiss.composition._method import (
     ilr_phylogenetic_differential,
     ilr_phylogenetic_ordination
 )
-from qiime2.plugin import Float, Int, List, Str
+from qiime2.plugin import Choices, Float, Int, List, Range, Str
+from q2_gneiss._util import _precisions, _precision_description
 
 
+_chunk_size_description = (
+    'Number of samples to transform at a time.  Smaller chunks bound the '
+    'memory used by intermediate copies of the table; the balances do not '
+    'depend on the chunk size.  By default the whole table is transformed '
+    'at once.')
+_n_jobs_description = (
+    'Number of threads over which blocks of samples are transformed (by '
+    'default, one block per thread).  The results do not depend on the '
+    'number of threads.')
+
 plugin.methods.register_function(
     function=ilr_hierarchical,
     inputs={'table': FeatureTable[Frequency | Composition],
             'tree': Hierarchy},
     outputs=[('balances', FeatureTable[Balance])],
-    parameters={'pseudocount': Float},
+    parameters={'pseudocount': Float,
+                'chunk_size': Int % Range(1, None),
+                'precision': Str % Choices(_precisions),
+                'n_jobs': Int % Range(1, None)},
     name='Isometric Log-ratio Transform applied to a hierarchical clustering',
     input_descriptions={
         'table': ('The feature table containing the samples in which '
@@ -39,7 +53,10 @@ plugin.methods.register_function(
                  'internal nodes in the tree have labels.')
     },
     parameter_descriptions={
-        'pseudocount': 'The value to add to zero counts in the feature table.'
+        'pseudocount': 'The value to add to zero counts in the feature table.',
+        'chunk_size': _chunk_size_description,
+        'precision': _precision_description,
+        'n_jobs': _n_jobs_description
     },
     output_descriptions={'balances': ('The resulting balances from the '
                                       'ilr transform.')},
@@ -53,7 +70,10 @@ plugin.methods.register_function(
             'tree': Phylogeny[Rooted]},
     outputs=[('balances', FeatureTable[Balance]),
              ('hierarchy', Hierarchy)],
-    parameters={'pseudocount': Float},
+    parameters={'pseudocount': Float,
+                'chunk_size': Int % Range(1, None),
+                'precision': Str % Choices(_precisions),
+                'n_jobs': Int % Range(1, None)},
     name='Isometric Log-ratio Transform applied to a phylogenetic tree',
     input_descriptions={
         'table': ('The feature table containing the samples in which '
@@ -69,7 +89,10 @@ plugin.methods.register_function(
                  'two children), in which case they will be bifurcated.')
     },
     parameter_descriptions={
-        'pseudocount': 'The value to add to zero counts in the feature table.'
+        'pseudocount': 'The value to add to zero counts in the feature table.',
+        'chunk_size': _chunk_size_description,
+        'precision': _precision_description,
+        'n_jobs': _n_jobs_description
     },
     output_descriptions={'balances': ('The resulting balances from the '
                                       'ilr transform.'),
@@ -85,7 +108,7 @@ plugin.methods.register_function(
     outputs=[('ilr_differential', FeatureData[Differential]),
              ('bifurcated_tree', Phylogeny[Rooted])],
     name=('Differentially abundant Phylogenetic Log Ratios.'),
-    parameters={},
+    parameters={'precision': Str % Choices(_precisions)},
     input_descriptions={
         'differential': (
             'The differential abundance results in which '
@@ -100,7 +123,7 @@ plugin.methods.register_function(
                  'contain polytomic nodes (i.e., nodes with more than '
                  'two children), in which case they will be bifurcated.')
     },
-    parameter_descriptions={},
+    parameter_descriptions={'precision': _precision_description},
     output_descriptions={
         'ilr_differential': 'Per clade differential abundance results.',
         'bifurcated_tree': 'Bifurcating phylogeny.'
@@ -119,7 +142,9 @@ plugin.methods.register_function(
              ('clade_metadata', FeatureData[Differential])],
     parameters={'pseudocount': Float,
                 'top_k_var': Int,
-                'clades': List[Str]},
+                'clades': List[Str],
+                'precision': Str % Choices(_precisions),
+                'n_jobs': Int % Range(1, None)},
     name='Ordination through a phylogenetic Isometric Log Ratio transform.',
     input_descriptions={
         'table': ('The feature table containing the samples in which '
@@ -138,6 +163,8 @@ plugin.methods.register_function(
         'pseudocount': 'The value to add to zero counts in the feature table.',
         'top_k_var': 'The top k most variable balances.',
         'clades': 'The names of clades to focus on (overrides top-k-var).',
+        'precision': _precision_description,
+        'n_jobs': _n_jobs_description
     },
     output_descriptions={
         'ordination': ('The resulting ordination from the '
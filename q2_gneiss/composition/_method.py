@@ -5,118 +5,163 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import biom
 import numpy as np
 import pandas as pd
 import skbio
-from gneiss.composition import ilr_transform
-from gneiss.util import match_tips
 from gneiss.util import rename_internal_nodes
-from gneiss.util import NUMERATOR, DENOMINATOR
 
-from q2_gneiss._util import add_pseudocount
-from gneiss.balances import _balance_basis
+from q2_gneiss._tree import TipIndex
+from q2_gneiss._util import (_dtype, _matrix, _parallel_map, _row_blocks,
+                             _shifted_log)
+from q2_gneiss.composition._balances import (
+    _balances, _balance_variance, _basis
+)
 from skbio import OrdinationResults
 
 
-def ilr_hierarchical(table: pd.DataFrame, tree: skbio.TreeNode,
-                     pseudocount: float = 0.5) -> pd.DataFrame:
-    return ilr_transform(add_pseudocount(table, pseudocount), tree)
-
-
-def ilr_phylogenetic(table: pd.DataFrame, tree: skbio.TreeNode,
-                     pseudocount: float = 0.5) -> (
+def _prepare(table, tree, rename=False):
+    # Matches the table and the tree like gneiss.util.match_tips, but
+    # indexes the tips of the tree once and returns a column indexer that
+    # permutes the (possibly sparse) matrix into tip order, instead of
+    # re-sorting the table itself.
+    mat, samples, features = _matrix(table)
+    tips = {n.name for n in tree.tips()}
+    _tree = tree.shear(names=[f for f in features if f in tips])
+    _tree.bifurcate()
+    _tree.prune()
+    if rename:
+        _tree = rename_internal_nodes(_tree)
+    index = TipIndex(_tree)
+    return mat, index.permutation(features), samples, index, _tree
+
+
+def _ilr(mat, perm, samples, index, pseudocount, ids=None,
+         chunk_size=None, dtype=np.float64, n_jobs=1):
+    # ilr transform of the matrix with its columns permuted by `perm`. Each
+    # block of `chunk_size` samples goes through pseudocount, log and
+    # balances on its own and is written into the preallocated output, so
+    # the temporaries are bounded by the chunk size. Zeros are never
+    # expanded (see `_shifted_log`) and the balances come from per-clade
+    # sums, so no basis is materialized. Everything from the log onwards is
+    # computed in `dtype`.
+    # The blocks are spread over `n_jobs` threads (by default, one block per
+    # thread). Every row is reduced on its own, so the balances do not
+    # depend on the blocks nor on the order in which they complete.
+    nodes = index.nodes if ids is None else [index.nodes[i] for i in ids]
+    ranges = index.ranges(ids)
+    balances = np.empty((mat.shape[0], len(nodes)), dtype=dtype)
+    if chunk_size is None and n_jobs > 1:
+        chunk_size = -(-mat.shape[0] // n_jobs)
+
+    def _transform(rows):
+        block = _shifted_log(mat[rows][:, perm], pseudocount, inplace=True,
+                             dtype=dtype)
+        balances[rows] = _balances(block, *ranges)
+
+    _parallel_map(_transform, _row_blocks(mat.shape[0], chunk_size), n_jobs)
+    return pd.DataFrame(balances, index=samples, columns=nodes)
+
+
+def ilr_hierarchical(table: biom.Table, tree: skbio.TreeNode,
+                     pseudocount: float = 0.5,
+                     chunk_size: int = None,
+                     precision: str = 'float64',
+                     n_jobs: int = 1) -> pd.DataFrame:
+    mat, perm, samples, index, _ = _prepare(table, tree)
+    return _ilr(mat, perm, samples, index, pseudocount,
+                chunk_size=chunk_size, dtype=_dtype(precision),
+                n_jobs=n_jobs)
+
+
+def ilr_phylogenetic(table: biom.Table, tree: skbio.TreeNode,
+                     pseudocount: float = 0.5,
+                     chunk_size: int = None,
+                     precision: str = 'float64',
+                     n_jobs: int = 1) -> (
                      pd.DataFrame, skbio.TreeNode):
     t = tree.copy()
     t.bifurcate()
-    table, t = match_tips(table, t)
-    t = rename_internal_nodes(t)
-    return ilr_transform(add_pseudocount(table, pseudocount), t), t
+    mat, perm, samples, index, t = _prepare(table, t, rename=True)
+    return _ilr(mat, perm, samples, index, pseudocount,
+                chunk_size=chunk_size, dtype=_dtype(precision),
+                n_jobs=n_jobs), t
 
 
 def ilr_phylogenetic_differential(
-        differential: pd.DataFrame, tree: skbio.TreeNode) -> (
+        differential: pd.DataFrame, tree: skbio.TreeNode,
+        precision: str = 'float64') -> (
             pd.DataFrame, skbio.TreeNode):
     t = tree.copy()
     t.bifurcate()
-    diff, _tree = match_tips(differential.T, t)
-    _tree = rename_internal_nodes(_tree)
-    in_nodes = [n.name for n in _tree.levelorder() if not n.is_tip()]
-    basis = _balance_basis(_tree)[0]
-    basis = pd.DataFrame(basis.T, index=diff.columns, columns=in_nodes)
-    diff_balances = (diff @ basis).T
+    diff, perm, covariates, index, _ = _prepare(differential.T, t,
+                                                rename=True)
+    diff = diff[:, perm].astype(_dtype(precision), copy=False)
+    diff_balances = pd.DataFrame(_balances(diff, *index.ranges()),
+                                 index=covariates, columns=index.nodes).T
     diff_balances.index.name = 'featureid'
     return diff_balances, t
 
 
-def get_children(tree, side):
-    if tree.children[side].is_tip():
-        return [tree.children[side].name]
-    else:
-        return [n.name for n in tree.children[side].tips()]
-
-
-def logmean(table, tips, pseudocount):
-    if len(tips) == 1:
-        return np.array(np.log(table[tips] + pseudocount)).ravel()
-    else:
-        return np.array(np.log(table[tips] + pseudocount).mean(axis=1))
-
-
-def _fast_ilr(tree, table, clades, pseudocount=0.5):
-    # manually computes the ILR transform on a subset of specified clades
-    balances = {}
-    basis = {}
-    for c in clades:
-        subtree = tree.find(c)
-        num_tips = get_children(subtree, NUMERATOR)
-        denom_tips = get_children(subtree, DENOMINATOR)
-        r, s = len(num_tips),  len(denom_tips)
-        if r == 0 or s == 0:
-            raise ValueError(f'Clade {c} has no children {subtree}')
-        Z = np.sqrt(r * s / (r + s))
-
-        num = logmean(table, num_tips, pseudocount)
-        denom = logmean(table, denom_tips, pseudocount)
-        print(num.shape, denom.shape)
-        balances[c] = pd.Series(Z * (num - denom), index=table.index)
-        basis[c] = pd.Series(np.zeros(len(table.columns)), index=table.columns)
-        basis[c].loc[num_tips] = np.sqrt(s / (r * (r + s)))
-        basis[c].loc[denom_tips] = -np.sqrt(s / (s * (r + s)))
-    balances = pd.DataFrame(balances)
-    basis = pd.DataFrame(basis)
+def _fast_ilr(index, mat, perm, samples, clades, pseudocount=0.5,
+              dtype=np.float64, n_jobs=1):
+    # computes the ILR transform on a subset of specified clades. The table
+    # is logged once and all of the clades are read off the same prefix sums
+    # over the (postorder) tips, instead of re-logging every clade's tips.
+    ids = index.node_ids(clades)
+    balances = _ilr(mat, perm, samples, index, pseudocount, ids,
+                    dtype=dtype, n_jobs=n_jobs)
+    basis = pd.DataFrame(_basis(*index.ranges(ids), len(index.tips),
+                                dtype=dtype),
+                         index=index.tips, columns=clades)
     return balances, basis
 
 
-def ilr_phylogenetic_ordination(table: pd.DataFrame, tree: skbio.TreeNode,
+def ilr_phylogenetic_ordination(table: biom.Table, tree: skbio.TreeNode,
                                 pseudocount: float = 0.5,
                                 top_k_var: int = 10,
-                                clades: list = None) -> (
+                                clades: list = None,
+                                precision: str = 'float64',
+                                n_jobs: int = 1) -> (
                                     OrdinationResults,
                                     skbio.TreeNode, pd.DataFrame
                                 ):
+    dtype = _dtype(precision)
     t = tree.copy()
     t.bifurcate()
-    _table, _tree = match_tips(table, t)
-    _tree = rename_internal_nodes(_tree)
+    mat, perm, samples, index, _tree = _prepare(table, t, rename=True)
     if not clades:
-        in_nodes = [n.name for n in _tree.levelorder() if not n.is_tip()]
-        basis = _balance_basis(_tree)[0]
-        _table = add_pseudocount(_table, pseudocount)
-        basis = pd.DataFrame(basis.T, index=_table.columns, columns=in_nodes)
-        balances = np.log(_table) @ basis
-        var = balances.var(axis=0).sort_values(ascending=False)
-        clades = var.index[:top_k_var]
-        balances = balances[clades]
-        basis = basis[clades]
+        # the variances are accumulated over blocks of samples, so only the
+        # top k balances are ever materialized. Since the ilr transform is
+        # an isometry, the variances of all of the balances add up to the
+        # total clr variance of the table.
+        def _log(block):
+            return _shifted_log(block[:, perm], pseudocount, inplace=True,
+                                dtype=dtype)
+
+        all_var = _balance_variance(mat, *index.ranges(), transform=_log,
+                                    n_jobs=n_jobs)
+        k = min(top_k_var, len(all_var))
+        ids = np.sort(np.argpartition(-all_var, k - 1)[:k])
+        ids = ids[np.argsort(-all_var[ids], kind='stable')]
+        clades = [index.nodes[i] for i in ids]
+        balances, basis = _fast_ilr(index, mat, perm, samples, clades,
+                                    pseudocount=pseudocount, dtype=dtype,
+                                    n_jobs=n_jobs)
+        var = pd.Series(all_var[ids], index=clades)
+        total_var = all_var.sum()
     else:
         clades = clades[0].split(',')
-        balances, basis = _fast_ilr(_tree, _table, clades, pseudocount=0.5)
+        balances, basis = _fast_ilr(index, mat, perm, samples, clades,
+                                    pseudocount=pseudocount, dtype=dtype,
+                                    n_jobs=n_jobs)
         var = balances.var(axis=0).sort_values(ascending=False)
+        total_var = var.sum()
 
     balances.index.name = 'sampleid'
     # feature metadata
     eigvals = var
-    prop = var[clades] / var.sum()
+    prop = var[clades] / total_var
     balances = OrdinationResults(
         short_method_name='ILR',
         long_method_name='Phylogenetic Isometric Log Ratio Transform',
@@ -0,0 +1,194 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2017-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+from unittest import mock
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import pdist
+from skbio import TreeNode
+from gneiss.balances import _balance_basis
+from gneiss.sort import gradient_sort as gneiss_sort
+from gneiss.util import rename_internal_nodes
+
+from q2_gneiss._tree import TipIndex, average_linkage_1d, gradient_sort
+from q2_gneiss.composition._balances import (
+    _basis, _basis_balances, _prefix_balances, _balance_variance
+)
+
+
+def random_tree(n_tips, seed=0):
+    x = np.random.RandomState(seed).rand(n_tips, 2)
+    t = TreeNode.from_linkage_matrix(linkage(x, 'average'),
+                                     ['t%d' % i for i in range(n_tips)])
+    return rename_internal_nodes(t)
+
+
+class TestTipIndex(unittest.TestCase):
+
+    def setUp(self):
+        tree = TreeNode.read(['(((a,b)y2,c)y1,((d,(e,f)y5)y4,g)y3)y0;'])
+        self.index = TipIndex(tree)
+
+    def test_ranges(self):
+        self.assertEqual(self.index.tips, list('abcdefg'))
+        self.assertEqual(self.index.nodes,
+                         ['y0', 'y1', 'y3', 'y2', 'y4', 'y5'])
+        start, split, stop = self.index.ranges()
+        npt.assert_array_equal(start, [0, 0, 3, 0, 3, 4])
+        npt.assert_array_equal(split, [3, 2, 6, 1, 4, 5])
+        npt.assert_array_equal(stop, [7, 3, 7, 2, 6, 6])
+
+    def test_lookups(self):
+        ids = self.index.node_ids(['y4', 'y1'])
+        npt.assert_array_equal(ids, [4, 1])
+        r, s = self.index.sizes(ids)
+        npt.assert_array_equal(r, [2, 1])
+        npt.assert_array_equal(s, [1, 2])
+        self.assertTrue(self.index.contains('y4', 'e'))
+        self.assertFalse(self.index.contains('y4', 'g'))
+        with self.assertRaisesRegex(ValueError, 'y9, a'):
+            self.index.node_ids(['y0', 'y9', 'a'])
+
+    def test_permutation(self):
+        features = ['g', 'x', 'a', 'f', 'e', 'd', 'c', 'b']
+        perm = self.index.permutation(features)
+        self.assertEqual([features[i] for i in perm], self.index.tips)
+        with self.assertRaisesRegex(ValueError, 'c'):
+            self.index.permutation(['a', 'b', 'd', 'e', 'f', 'g'])
+
+    def test_polytomy(self):
+        tree = TreeNode.read(['((a,b,c)y1,d)y0;'])
+        with self.assertRaises(ValueError):
+            TipIndex(tree)
+
+    def test_basis(self):
+        tree = random_tree(50)
+        exp, exp_nodes = _balance_basis(tree)
+        index = TipIndex(tree)
+        self.assertEqual(index.nodes, exp_nodes)
+        npt.assert_allclose(_basis(*index.ranges(), 50), exp.T, atol=1e-12)
+
+
+class TestAverageLinkage1D(unittest.TestCase):
+
+    def test_scipy(self):
+        for seed in range(5):
+            x = np.random.RandomState(seed).rand(40)
+            npt.assert_allclose(average_linkage_1d(x),
+                                linkage(pdist(x[:, None]), 'average'))
+
+    def test_ties(self):
+        exp = np.array([[0, 1, 1, 2], [2, 3, 1, 2], [4, 5, 2, 4]])
+        npt.assert_array_equal(average_linkage_1d([1.5, 2.5, 3.5, 4.5]), exp)
+        # the same pairs, merged from left to right in sorted order
+        npt.assert_array_equal(average_linkage_1d([4.5, 3.5, 2.5, 1.5]),
+                               exp[[1, 0, 2]])
+
+    def test_single(self):
+        with self.assertRaises(ValueError):
+            average_linkage_1d([1.0])
+
+
+class TestGradientSort(unittest.TestCase):
+
+    def test_gneiss(self):
+        for seed in range(5):
+            tree = random_tree(30, seed)
+            state = np.random.RandomState(seed)
+            gradient = pd.Series(state.randint(0, 5, 30).astype(float),
+                                 index=['t%d' % i for i in range(30)])
+            for ascending in (True, False):
+                self.assertEqual(
+                    str(gradient_sort(tree, gradient, ascending)),
+                    str(gneiss_sort(tree, gradient, ascending)))
+
+    def test_polytomy(self):
+        tree = TreeNode.read(['((a,b,c)x,d,(e,f)y)r;'])
+        gradient = pd.Series({'a': 3.0, 'b': 1.0, 'c': 2.0, 'd': 0.0,
+                              'e': 9.0, 'f': 0.0})
+        res = gradient_sort(tree, gradient)
+        self.assertEqual(str(res), '((a,b,c)x,(e,f)y,d)r;\n')
+        self.assertEqual(str(tree), '((a,b,c)x,d,(e,f)y)r;\n')
+        gradient_sort(tree, gradient, inplace=True)
+        self.assertEqual(str(tree), str(res))
+
+    def test_deep(self):
+        # a caterpillar much deeper than the recursion limit
+        tree = TreeNode(name='t0')
+        for i in range(1, 5000):
+            tree = TreeNode(children=[TreeNode(name='t%d' % i), tree])
+        gradient = pd.Series(np.arange(5000.0),
+                             index=['t%d' % i for i in range(5000)])
+        res = gradient_sort(tree, gradient, inplace=True)
+        # tips come after their internal siblings, like in gneiss
+        exp = ['t1', 't0'] + ['t%d' % i for i in range(2, 5000)]
+        self.assertEqual([t.name for t in res.tips()], exp)
+
+    def test_not_numeric(self):
+        with self.assertRaises(ValueError):
+            gradient_sort(random_tree(3), pd.Series(['a', 'b', 'c']))
+
+
+class TestBalances(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = random_tree(300)
+        state = np.random.RandomState(1)
+        self.mat = np.log(state.lognormal(size=(20, 300)))
+        basis, _ = _balance_basis(self.tree)
+        self.exp = self.mat @ basis.T
+
+    def test_basis_balances(self):
+        ranges = TipIndex(self.tree).ranges()
+        npt.assert_allclose(_basis_balances(self.mat, *ranges), self.exp,
+                            atol=1e-10)
+
+    def test_prefix_balances(self):
+        ranges = TipIndex(self.tree).ranges()
+        npt.assert_allclose(_prefix_balances(self.mat, *ranges), self.exp,
+                            atol=1e-10)
+
+    def test_prefix_balances_sparse(self):
+        ranges = TipIndex(self.tree).ranges()
+        mat = self.mat.copy()
+        mat[mat < 0.5] = 0
+        basis, _ = _balance_basis(self.tree)
+        npt.assert_allclose(_prefix_balances(csr_matrix(mat), *ranges),
+                            mat @ basis.T, atol=1e-10)
+
+
+class TestBalanceVariance(unittest.TestCase):
+
+    def test_balance_variance(self):
+        tree = random_tree(300)
+        mat = np.log(np.random.RandomState(2).lognormal(size=(50, 300)))
+        basis, _ = _balance_basis(tree)
+        exp = (mat @ basis.T).var(axis=0, ddof=1)
+        ranges = TipIndex(tree).ranges()
+        npt.assert_allclose(_balance_variance(mat, *ranges), exp)
+        # blocks of 3 samples, merged pairwise
+        with mock.patch('q2_gneiss.composition._balances._BLOCK_ENTRIES',
+                        1000):
+            npt.assert_allclose(_balance_variance(mat, *ranges), exp)
+
+    def test_total_variance(self):
+        # the ilr transform is an isometry, so the balance variances add up
+        # to the total clr variance
+        tree = random_tree(20)
+        mat = np.log(np.random.RandomState(3).lognormal(size=(10, 20)))
+        clr = mat - mat.mean(axis=1, keepdims=True)
+        var = _balance_variance(mat, *TipIndex(tree).ranges())
+        npt.assert_allclose(var.sum(), clr.var(axis=0, ddof=1).sum())
+
+
+if __name__ == '__main__':
+    unittest.main()
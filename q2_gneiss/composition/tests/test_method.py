@@ -6,15 +6,20 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 import unittest
+from unittest import mock
+import biom
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.cluster.hierarchy import linkage
 from skbio.tree import TreeNode
 import pandas.testing as pdt
 
 from q2_gneiss.composition._method import (
     ilr_hierarchical, ilr_phylogenetic, ilr_phylogenetic_ordination
 )
-from q2_gneiss._util import add_pseudocount
+from q2_gneiss._util import add_pseudocount, _log_pseudocount, _shifted_log
 from q2_gneiss.hacks import gradient_linkage
 
 
@@ -51,6 +56,45 @@ class TestAddPseudocount(unittest.TestCase):
         pdt.assert_frame_equal(obs, exp)
 
 
+class TestLogPseudocount(unittest.TestCase):
+
+    def test_log_pseudocount(self):
+        table = np.array([[1, 0, 3], [0, 2, 1]])
+        obs = _log_pseudocount(table, 0.5)
+        exp = np.log(add_pseudocount(pd.DataFrame(table), 0.5).values)
+        npt.assert_allclose(obs, exp)
+        npt.assert_array_equal(table, [[1, 0, 3], [0, 2, 1]])
+
+    def test_log_pseudocount_inplace(self):
+        table = np.array([[1., 0., 3.], [0., 2., 0.25]])
+        exp = np.log([[1., 0.5, 3.], [0.5, 2., 0.25]])
+        obs = _log_pseudocount(table, 0.5, inplace=True)
+        self.assertIs(obs, table)
+        npt.assert_allclose(table, exp)
+
+    def test_log_pseudocount_inplace_int(self):
+        table = np.array([[1, 0], [0, 2]])
+        obs = _log_pseudocount(table, 0.5, inplace=True)
+        self.assertIsNot(obs, table)
+        npt.assert_allclose(obs, np.log([[1, 0.5], [0.5, 2]]))
+
+
+class TestShiftedLog(unittest.TestCase):
+
+    def test_shifted_log_dense(self):
+        table = np.array([[1., 0., 3.], [0., 2., 0.5]])
+        obs = _shifted_log(table, 0.5)
+        exp = np.log(add_pseudocount(pd.DataFrame(table), 0.5).values)
+        npt.assert_allclose(obs, exp - np.log(0.5))
+        self.assertEqual(table[0, 1], 0)
+
+    def test_shifted_log_sparse(self):
+        table = np.array([[1., 0., 3.], [0., 2., 0.5]])
+        obs = _shifted_log(csr_matrix(table), 0.5)
+        self.assertEqual(obs.nnz, 4)
+        npt.assert_allclose(obs.toarray(), _shifted_log(table, 0.5))
+
+
 class TestILRTransform(unittest.TestCase):
 
     def test_ilr_hierarchical(self):
@@ -72,6 +116,93 @@ class TestILRTransform(unittest.TestCase):
             index=[1, 2, 3])
         pdt.assert_frame_equal(res_balances, exp_balances)
 
+    def test_ilr_hierarchical_sparse(self):
+        table = pd.DataFrame([[1, 0, 2, 2],
+                              [1, 2, 0, 1],
+                              [2, 2, 1, 0]],
+                             index=['s1', 's2', 's3'],
+                             columns=['a', 'b', 'c', 'd'])
+        tree = TreeNode.read(['((b,a)y1,(c,d)y2)y0;'])
+        exp_balances = ilr_hierarchical(table, tree)
+        sparse_table = biom.Table(table.values.T, list(table.columns),
+                                  list(table.index))
+        res_balances = ilr_hierarchical(sparse_table, tree)
+        pdt.assert_frame_equal(res_balances, exp_balances,
+                               check_index_type=False)
+        exp = np.log(add_pseudocount(table))
+        npt.assert_allclose(res_balances['y1'],
+                            (exp['a'] - exp['b']) / np.sqrt(2))
+
+    def test_ilr_hierarchical_chunked(self):
+        state = np.random.RandomState(0)
+        for n_features in [20, 300]:
+            features = ['f%d' % i for i in range(n_features)]
+            tree = TreeNode.from_linkage_matrix(
+                linkage(state.rand(n_features, 2), 'ward'), features)
+            tree = tree.shear(features)
+            for i, n in enumerate(tree.levelorder()):
+                n.name = n.name if n.is_tip() else 'y%d' % i
+            counts = state.poisson(1, size=(25, n_features))
+            table = pd.DataFrame(counts, columns=features,
+                                 index=['s%d' % i for i in range(25)])
+            sparse_table = biom.Table(counts.T, features, list(table.index))
+            exp = ilr_hierarchical(table, tree)
+            exp_sparse = ilr_hierarchical(sparse_table, tree)
+            npt.assert_allclose(exp_sparse.values, exp.values, atol=1e-12)
+            for chunk_size in [1, 7, 25, 100]:
+                res = ilr_hierarchical(table, tree, chunk_size=chunk_size)
+                npt.assert_array_equal(res.values, exp.values)
+                res = ilr_hierarchical(sparse_table, tree,
+                                       chunk_size=chunk_size)
+                npt.assert_array_equal(res.values, exp_sparse.values)
+
+    def test_ilr_hierarchical_threads(self):
+        state = np.random.RandomState(3)
+        features = ['f%d' % i for i in range(300)]
+        tree = TreeNode.from_linkage_matrix(
+            linkage(state.rand(300, 2), 'ward'), features)
+        for i, n in enumerate(tree.levelorder()):
+            n.name = n.name if n.is_tip() else 'y%d' % i
+        counts = state.poisson(1, size=(50, 300))
+        table = pd.DataFrame(counts, columns=features,
+                             index=['s%d' % i for i in range(50)])
+        sparse_table = biom.Table(counts.T, features, list(table.index))
+        for t in [table, sparse_table]:
+            exp = ilr_hierarchical(t, tree)
+            for n_jobs, chunk_size in [(2, None), (4, None), (3, 7)]:
+                res = ilr_hierarchical(t, tree, chunk_size=chunk_size,
+                                       n_jobs=n_jobs)
+                pdt.assert_frame_equal(res, exp)
+        with self.assertRaisesRegex(ValueError, 'n_jobs'):
+            ilr_hierarchical(table, tree, n_jobs=0)
+
+    def test_ilr_hierarchical_precision(self):
+        # float32 balances are within the bound documented for `precision`:
+        # n * eps times the largest absolute log abundance, with n the
+        # number of features
+        eps = np.finfo(np.float32).eps
+        state = np.random.RandomState(1)
+        for n_features in [20, 300]:
+            features = ['f%d' % i for i in range(n_features)]
+            tree = TreeNode.from_linkage_matrix(
+                linkage(state.rand(n_features, 2), 'ward'), features)
+            for i, n in enumerate(tree.levelorder()):
+                n.name = n.name if n.is_tip() else 'y%d' % i
+            counts = state.poisson(state.lognormal(3, 2, (40, n_features)))
+            table = pd.DataFrame(counts, columns=features,
+                                 index=['s%d' % i for i in range(40)])
+            sparse_table = biom.Table(counts.T, features, list(table.index))
+            bound = n_features * eps * np.log(add_pseudocount(table)).abs(
+                ).values.max()
+            exp = ilr_hierarchical(table, tree)
+            for t in [table, sparse_table]:
+                res = ilr_hierarchical(t, tree, precision='float32')
+                self.assertTrue((res.dtypes == np.float32).all())
+                npt.assert_allclose(res.values, exp.values, rtol=0,
+                                    atol=bound)
+        with self.assertRaisesRegex(ValueError, 'float16'):
+            ilr_hierarchical(table, tree, precision='float16')
+
     def test_ilr_phylogenetic(self):
         np.random.seed(0)
         table = pd.DataFrame([[1, 1, 2, 2],
@@ -153,6 +284,70 @@ class TestILRTransform(unittest.TestCase):
         exp_md.index.name = 'featureid'
         pdt.assert_frame_equal(res_md, exp_md)
 
+    def test_ilr_ordination_clades(self):
+        table = pd.DataFrame([[1, 1, 2, 2],
+                              [1, 2, 2, 1],
+                              [2, 2, 1, 0]],
+                             index=[1, 2, 3],
+                             columns=['a', 'b', 'c', 'd'])
+        tree = TreeNode.read([
+            '((c:0.025,d:0.025,f:0.1,e:0.025):0.2,(b:0.025,a:0.025):0.2);'])
+        exp_ord, _, exp_md = ilr_phylogenetic_ordination(
+            table, tree, pseudocount=0.1, top_k_var=3)
+        res_ord, res_tree, res_md = ilr_phylogenetic_ordination(
+            table, tree, pseudocount=0.1, clades=['y2,y0'])
+        pdt.assert_frame_equal(res_ord.samples,
+                               exp_ord.samples[['y2', 'y0']])
+        pdt.assert_frame_equal(res_md, exp_md[['y2', 'y0']])
+
+    def test_ilr_ordination_precision(self):
+        eps = np.finfo(np.float32).eps
+        state = np.random.RandomState(2)
+        table = pd.DataFrame(state.poisson(10, size=(30, 8)),
+                             columns=list('abcdefgh'))
+        tree = TreeNode.read(['(((a,b),(c,d)),((e,f),(g,h)));'])
+        bound = 8 * eps * np.log(add_pseudocount(table)).abs().values.max()
+        exp_ord, _, exp_md = ilr_phylogenetic_ordination(table, tree,
+                                                         top_k_var=7)
+        res_ord, _, res_md = ilr_phylogenetic_ordination(
+            table, tree, top_k_var=7, precision='float32')
+        self.assertEqual(list(res_ord.samples.columns),
+                         list(exp_ord.samples.columns))
+        npt.assert_allclose(res_ord.samples.values, exp_ord.samples.values,
+                            rtol=0, atol=bound)
+        npt.assert_allclose(res_ord.eigvals.values, exp_ord.eigvals.values,
+                            rtol=1e-4)
+        npt.assert_allclose(res_md.values, exp_md.values, rtol=1e-6)
+
+    def test_ilr_ordination_threads(self):
+        state = np.random.RandomState(4)
+        table = pd.DataFrame(state.poisson(10, size=(30, 8)),
+                             columns=list('abcdefgh'))
+        tree = TreeNode.read(['(((a,b),(c,d)),((e,f),(g,h)));'])
+        exp_ord, _, exp_md = ilr_phylogenetic_ordination(table, tree,
+                                                         top_k_var=4)
+        # blocks of 2 samples, so that the variances come from many blocks
+        with mock.patch('q2_gneiss.composition._balances._BLOCK_ENTRIES',
+                        16):
+            exp_var = ilr_phylogenetic_ordination(table, tree, top_k_var=4)
+            res_var = ilr_phylogenetic_ordination(table, tree, top_k_var=4,
+                                                  n_jobs=3)
+        pdt.assert_series_equal(res_var[0].eigvals, exp_var[0].eigvals)
+        res_ord, _, res_md = ilr_phylogenetic_ordination(
+            table, tree, top_k_var=4, n_jobs=4)
+        pdt.assert_frame_equal(res_ord.samples, exp_ord.samples)
+        pdt.assert_series_equal(res_ord.eigvals, exp_ord.eigvals)
+        pdt.assert_frame_equal(res_md, exp_md)
+
+    def test_ilr_ordination_missing_clade(self):
+        table = pd.DataFrame([[1, 1, 2, 2],
+                              [2, 2, 1, 1]],
+                             index=[1, 2],
+                             columns=['a', 'b', 'c', 'd'])
+        tree = TreeNode.read(['((c,d),(b,a));'])
+        with self.assertRaisesRegex(ValueError, 'y7, a'):
+            ilr_phylogenetic_ordination(table, tree, clades=['y0,y7,a'])
+
 
 if __name__ == '__main__':
     unittest.main()
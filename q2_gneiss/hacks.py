@@ -10,6 +10,8 @@
 # These updates allow `gradient_linkage` to work with scipy=1.9.0 which
 # prevent euclidean from accepting scalar inputs.
 # Instead a lambda which is equivalent to euclidean in the 0d case is used.
+# Average linkage, the default, is built by `average_linkage_1d`, which
+# sorts the values once instead of building a distance matrix.
 
 # The code below this point originated from gneiss, and is subject to the
 # following copyright and terms:
@@ -52,6 +54,8 @@ from skbio import DistanceMatrix, TreeNode
 from gneiss.sort import mean_niche_estimator
 from gneiss.util import match, rename_internal_nodes
 
+from q2_gneiss._tree import average_linkage_1d
+
 
 def gradient_linkage(X, y, method='average'):
     # Taken from https://github.com/biocore/gneiss/blob
@@ -66,11 +70,14 @@ def _rank_linkage(r, method='average'):
     # modified from https://github.com/biocore/gneiss/blob
     # /5d253d68ef14fa82e26b5f74118ff170f1990585/gneiss/cluster/_pba.py#L82
     # START MODIFICATION
-    def euclidean_1d(a, b): return np.abs(b-a)
-    dm = DistanceMatrix.from_iterable(r, euclidean_1d)
+    if method == 'average':
+        lm = average_linkage_1d(r.values)
+    else:
+        def euclidean_1d(a, b): return np.abs(b-a)
+        dm = DistanceMatrix.from_iterable(r, euclidean_1d)
+        lm = linkage(dm.condensed_form(), method)
     # END MODIFICATION
 
-    lm = linkage(dm.condensed_form(), method)
     t = TreeNode.from_linkage_matrix(lm, r.index)
     t = rename_internal_nodes(t)
     return t
@@ -7,7 +7,6 @@
 # ----------------------------------------------------------------------------
 import os
 
-import numpy as np
 import pandas as pd
 import qiime2
 from gneiss.plot._heatmap import heatmap
@@ -17,9 +16,9 @@ from q2_types.tree import Hierarchy
 from qiime2.plugin import (Int, MetadataColumn, Categorical,
                            Str, Choices, Float)
 from skbio import TreeNode
-from skbio.stats.composition import clr, centralize
 
-from q2_gneiss._util import add_pseudocount
+from q2_gneiss._util import (_dtype, _log_pseudocount, _precisions,
+                             _precision_description)
 from q2_gneiss.plugin_setup import plugin
 
 _transform_methods = ['clr', 'log']
@@ -49,23 +48,24 @@ def dendrogram_heatmap(output_dir: str, table: pd.DataFrame,
                        metadata: qiime2.CategoricalMetadataColumn,
                        pseudocount: float = 0.5,
                        ndim: int = 10, method: str = 'clr',
-                       color_map: str = 'viridis'):
+                       color_map: str = 'viridis',
+                       precision: str = 'float64'):
 
-    table, tree = match_tips(add_pseudocount(table, pseudocount), tree)
+    table, tree = match_tips(table, tree)
     nodes = [n.name for n in tree.levelorder() if not n.is_tip()]
 
     nlen = min(ndim, len(nodes))
     numerator_color, denominator_color = '#fb9a99', '#e31a1c'
     highlights = pd.DataFrame([[numerator_color, denominator_color]] * nlen,
                               index=nodes[:nlen])
+    # match_tips returns a fresh copy of the table, which can be logged in
+    # place. In log space, clr(centralize(x)) is a double centering.
+    mat = _log_pseudocount(table.values, pseudocount, inplace=True,
+                           dtype=_dtype(precision))
     if method == 'clr':
-        mat = pd.DataFrame(clr(centralize(table)),
-                           index=table.index,
-                           columns=table.columns)
-    elif method == 'log':
-        mat = pd.DataFrame(np.log(table),
-                           index=table.index,
-                           columns=table.columns)
+        mat -= mat.mean(axis=0)
+        mat -= mat.mean(axis=1, keepdims=True)
+    mat = pd.DataFrame(mat, index=table.index, columns=table.columns)
     c = metadata.to_series()
     table, c = match(table, c)
     # TODO: There are a few hard-coded constants here
@@ -116,7 +116,8 @@ plugin.visualizers.register_function(
                 'ndim': Int,
                 'pseudocount': Float,
                 'method': Str % Choices(_transform_methods),
-                'color_map': Str % Choices(_mpl_colormaps)},
+                'color_map': Str % Choices(_mpl_colormaps),
+                'precision': Str % Choices(_precisions)},
     input_descriptions={
         'table': ('The feature table that will be plotted as a heatmap. '
                   'This table is assumed to have strictly positive values.'),
@@ -133,7 +134,8 @@ plugin.visualizers.register_function(
                    "Options include 'log' or 'clr' (default='clr')."),
         'color_map': ("Specifies the color map for plotting the heatmap. "
                       "See https://matplotlib.org/examples/color/"
-                      "colormaps_reference.html for more details.")
+                      "colormaps_reference.html for more details."),
+        'precision': _precision_description
     },
     name='Dendrogram heatmap.',
     description=("Visualize the feature table as a heatmap, "
@@ -8,13 +8,18 @@
 import os
 import shutil
 import unittest
+from unittest import mock
 
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
+import pandas.testing as pdt
 from qiime2 import CategoricalMetadataColumn
 from scipy.cluster.hierarchy import ward
 from skbio import TreeNode, DistanceMatrix
+from skbio.stats.composition import clr, centralize
 
+from q2_gneiss._util import add_pseudocount
 from q2_gneiss.plot._plot import dendrogram_heatmap
 
 
@@ -60,6 +65,48 @@ class TestHeatmap(unittest.TestCase):
             self.assertIn('<h1>Dendrogram heatmap</h1>',
                           html)
 
+    def plotted_matrix(self, *args, **kwargs):
+        # the matrix that dendrogram_heatmap passes to gneiss' heatmap
+        with mock.patch('q2_gneiss.plot._plot.heatmap') as heatmap:
+            dendrogram_heatmap(self.results, *args, **kwargs)
+        return heatmap.call_args[0][0]
+
+    def test_heatmap_matrix(self):
+        np.random.seed(0)
+        index = pd.Index(np.arange(5).astype(str), name='id')
+        table = pd.DataFrame(np.random.poisson(2, (len(index), 4)),
+                             index=index, columns=list('abcd'))
+        orig = table.copy()
+        t = TreeNode.read(['((c,a)y1,(d,b)y2)y0;'])
+        md = CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', 'b', 'b'], index=index,
+                      name='column-name'))
+        exp = add_pseudocount(table, 0.5)[['c', 'a', 'd', 'b']]
+
+        res = self.plotted_matrix(table, t, md, method='clr')
+        pdt.assert_frame_equal(table, orig)
+        self.assertEqual(list(res.columns), ['c', 'a', 'd', 'b'])
+        npt.assert_allclose(res.values, clr(centralize(exp)), atol=1e-12)
+
+        res = self.plotted_matrix(table, t, md, method='log')
+        pdt.assert_frame_equal(table, orig)
+        npt.assert_allclose(res.values, np.log(exp), atol=1e-12)
+
+    def test_heatmap_float32(self):
+        np.random.seed(0)
+        index = pd.Index(np.arange(5).astype(str), name='id')
+        table = pd.DataFrame(np.random.poisson(20, (len(index), 4)),
+                             index=index, columns=list('abcd'))
+        t = TreeNode.read(['((c,a)y1,(d,b)y2)y0;'])
+        md = CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', 'b', 'b'], index=index,
+                      name='column-name'))
+        exp = self.plotted_matrix(table, t, md, method='log')
+        res = self.plotted_matrix(table, t, md, method='log',
+                                  precision='float32')
+        self.assertEqual(res.values.dtype, np.float32)
+        npt.assert_allclose(res.values, exp.values, rtol=1e-6)
+
     def test_visualization_small(self):
         # tests the scenario where ndim > number of tips
         np.random.seed(0)